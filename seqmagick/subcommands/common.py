@@ -11,6 +11,8 @@ import signal
 import sys
 import tempfile
 
+from seqmagick import transform
+
 @contextlib.contextmanager
 def atomic_write(path, **kwargs):
     """
@@ -70,6 +72,32 @@ def cut_range(string):
     return slice(start, stop)
 
 
+def quality_bins(string):
+    """
+    A custom argparse 'type' for quality score bins: either 'illumina', for
+    Illumina 8-level binning, or a comma-separated list of min:value pairs,
+    e.g. 0:2,10:15,20:30. Scores of at least min, and below the next min, are
+    replaced with value.
+
+    Returns a list of (min, value) tuples.
+    """
+    if string.lower() == 'illumina':
+        return list(transform.ILLUMINA_QUALITY_BINS)
+    try:
+        bins = [tuple(int(i) for i in pair.split(':'))
+                for pair in string.split(',')]
+    except ValueError:
+        bins = None
+    if not bins or any(len(b) != 2 or not all(0 <= i <= 93 for i in b)
+                       for b in bins):
+        msg = "{0} is not a valid list of quality bins.".format(string)
+        raise argparse.ArgumentTypeError(msg)
+    if len(set(minimum for minimum, _ in bins)) != len(bins):
+        msg = "Duplicate quality bin in {0}".format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return bins
+
+
 def typed_range(type_func, minimum, maximum):
     """
     Require variables to be of the specified type, between minimum and maximum
@@ -85,6 +113,18 @@ def typed_range(type_func, minimum, maximum):
     return inner
 
 
+def false_positive_rate(string):
+    """
+    Parse a false positive rate, which must be strictly between 0 and 1
+    """
+    result = float(string)
+    if not 0.0 < result < 1.0:
+        raise argparse.ArgumentTypeError(
+                "False positive rate must be between 0 and 1 (exclusive): " +
+                string)
+    return result
+
+
 def partial_append_action(fn, argument_keys=None):
     """
     Creates a new class extending argparse.Action, which appends a
@@ -22,6 +22,10 @@ ALPHABETS = {
         'rna-ambiguous': IUPAC.ambiguous_rna,
 }
 
+# Transforms which take a false positive rate for --id-filter-fpr
+ID_FILTERS = (transform.deduplicate_taxa, transform.exclude_from_file,
+              transform.include_from_file)
+
 def add_options(parser):
     """
     Add optional arguments to the parser
@@ -32,6 +36,11 @@ def add_options(parser):
         type=int, help='Adjust line wrap for sequence strings.  '
         'When N is 0, all line breaks are removed. Only fasta files '
         'are supported for the output format.')
+    file_mods.add_argument('--quality-bins', metavar='BINS',
+        type=common.quality_bins, help='Replace quality scores with binned '
+        'values on output, to improve compression: either "illumina" for '
+        'Illumina 8-level binning, or a comma-separated list of min:value '
+        'pairs, e.g. 0:2,10:15,20:30.')
     file_mods.add_argument('--sort', dest='sort',
         choices=['length-asc', 'length-desc', 'name-asc', 'name-desc'],
         help='Perform sorting by length or name, ascending or descending. '
@@ -114,6 +123,27 @@ def add_options(parser):
         metavar='FILE', dest='deduplicate_sequences', default=False,
         type=argparse.FileType('w'),
         help='Write all of the deduplicated sequences to a file')
+    seq_select.add_argument('--deduplicated-pairs-file', metavar='FILE',
+            type=argparse.FileType('w'), help="""Remove any duplicate
+            sequences, as --deduplicate-sequences, writing a tab-delimited
+            representative ID, member ID line for each record to FILE as it
+            is read. The representative is the first record with the same
+            sequence.""")
+    seq_select.add_argument('--dereplicate', action='store_true',
+            help="""Remove any duplicate sequences, keeping the first
+            instance seen, with ';size=N' appended to its ID, where N is the
+            number of records with the sequence""")
+    seq_select.add_argument('--sort-by-size', action='store_true',
+            help="""Sort dereplicated sequences by decreasing size, rather
+            than by first instance. Requires --dereplicate.""")
+    seq_select.add_argument('--deduplicate-partitions', metavar='K',
+            type=common.positive_value(int), help="""Deduplicate sequences
+            on disk, in K partitions, for inputs with more distinct sequences
+            than fit in memory. Each partition holds 20 bytes per record.
+            Requires --deduplicate-sequences.""")
+    seq_select.add_argument('--either-strand', action='store_true',
+            help="""Treat a sequence and its reverse complement as
+            identical when deduplicating or dereplicating sequences""")
     seq_select.add_argument('--deduplicate-taxa',
             action=partial_action(transform.deduplicate_taxa),
             dest='transforms', help="""Remove any duplicate sequences by ID,
@@ -126,6 +156,12 @@ def add_options(parser):
             type=argparse.FileType('r'), help="""Filter sequences, keeping only
             those sequence IDs in the specified file""", dest='transforms',
             action=partial_action(transform.include_from_file, 'handle'))
+    seq_select.add_argument('--id-filter-fpr', metavar='RATE',
+            type=common.false_positive_rate, help="""Hold IDs for
+            --deduplicate-taxa, --exclude-from-file and --include-from-file in
+            a Bloom filter with false positive rate RATE, confirming matches
+            exactly on disk, for inputs with more IDs than fit in memory.
+            Memory use is about 2 bytes per ID at RATE 0.01.""")
     seq_select.add_argument('--head', metavar='N', dest='transforms', type=int,
             action=partial_action(transform.head, 'head'), help="""Trim
             down to top N sequences""")
@@ -238,6 +274,11 @@ def transform_file(source_file, destination_file, arguments):
                 alphabet=ALPHABETS.get(arguments.alphabet))
 
 
+    if arguments.id_filter_fpr is not None and not any(
+            f.func in ID_FILTERS for f in arguments.transforms or ()):
+        raise ValueError("--id-filter-fpr requires --deduplicate-taxa, "
+                         "--exclude-from-file or --include-from-file")
+
     #########################################
     # Apply generator functions to iterator.#
     #########################################
@@ -264,19 +305,57 @@ def transform_file(source_file, destination_file, arguments):
                         functools.partial(n,
                             record_id=arguments.cut_relative, **f.keywords))
 
+        # Special case handling for --id-filter-fpr
+        if arguments.id_filter_fpr is not None:
+            arguments.transforms = [
+                    functools.partial(f.func, **dict(f.keywords,
+                        fpr=arguments.id_filter_fpr))
+                    if f.func in ID_FILTERS else f
+                    for f in arguments.transforms]
+
         for function in arguments.transforms:
             records = function(records)
 
-    if (arguments.deduplicate_sequences or
-            arguments.deduplicate_sequences is None):
+    if arguments.sort_by_size and not arguments.dereplicate:
+        raise ValueError("--sort-by-size requires --dereplicate")
+    if arguments.either_strand and not (arguments.dereplicate or
+            arguments.deduplicate_sequences is not False or
+            arguments.deduplicated_pairs_file):
+        raise ValueError("--either-strand requires a sequence deduplication "
+                         "option")
+    if arguments.dereplicate:
+        if (arguments.deduplicate_sequences is not False or
+                arguments.deduplicated_pairs_file or
+                arguments.deduplicate_partitions):
+            raise ValueError("--dereplicate is not supported with other "
+                             "sequence deduplication options")
+        records = transform.dereplicate_sequences(records,
+                arguments.sort_by_size, arguments.either_strand)
+    elif arguments.deduplicate_partitions:
+        if (arguments.deduplicate_sequences is not None or
+                arguments.deduplicated_pairs_file):
+            raise ValueError("--deduplicate-partitions requires "
+                             "--deduplicate-sequences, and is not supported "
+                             "with --deduplicated-sequences-file or "
+                             "--deduplicated-pairs-file")
+        records = transform.deduplicate_sequences_partitioned(
+            records, arguments.deduplicate_partitions,
+            arguments.either_strand)
+    elif (arguments.deduplicate_sequences or
+            arguments.deduplicate_sequences is None or
+            arguments.deduplicated_pairs_file):
         records = transform.deduplicate_sequences(
-            records, arguments.deduplicate_sequences)
+            records, arguments.deduplicate_sequences or None,
+            arguments.deduplicated_pairs_file, arguments.either_strand)
 
     # Apply all the partial functions
     if arguments.apply_function:
         for apply_function in arguments.apply_function:
             records = apply_function(records)
 
+    if arguments.quality_bins:
+        records = transform.bin_quality_scores(records, arguments.quality_bins)
+
     # Only the fasta format is supported, as SeqIO.write does not have a 'wrap'
     # parameter.
     if (arguments.line_wrap is not None and destination_file_type == 'fasta'
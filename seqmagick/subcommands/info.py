@@ -4,15 +4,39 @@ Info action
 
 import argparse
 import collections
+from cStringIO import StringIO
 import csv
+import functools
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+import os.path
+import sqlite3
 import sys
 
 from Bio import SeqIO
+import numpy
 
 from seqmagick import fileformat
 
 from . import common
 
+# Size of blocks read when scanning FASTA and FASTQ files
+DEFAULT_BLOCK_SIZE = 1 << 22
+
+# Default number and size of byte ranges read from each file with --sample
+DEFAULT_SAMPLE_BLOCKS = 64
+DEFAULT_SAMPLE_BLOCK_SIZE = 1 << 20
+
+# Standard normal quantile for 95% confidence bounds with --sample
+_Z_95 = 1.959964
+
+# Version of cached summaries; increment when summaries change
+_CACHE_VERSION = 1
+
 def build_parser(parser):
     parser.add_argument('source_files', metavar='sequence_files', nargs='+')
     parser.add_argument('--input-format', help="""Input format. Overrides
@@ -26,16 +50,78 @@ def build_parser(parser):
         tab-delimited, CSV or aligned in a borderless table.  Default is
         tab-delimited if the output is directed to a file, aligned if output to
         the console.""")
+    parser.add_argument('--stats', action='store_true', help="""Include
+            extended statistics: total length, N50 and N90, the GC content
+            of unambiguous nucleotides, and the fractions of residues which
+            are ambiguous and of sites which are gaps.""")
+    parser.add_argument('--length-histogram', type=argparse.FileType('w'),
+            metavar='FILE', help="""Write a histogram of sequence lengths in
+            each file to FILE, as tab-delimited name, min_len, max_len, count
+            rows.""")
+    parser.add_argument('--histogram-bin-width', metavar='WIDTH',
+            type=common.positive_value(int), default=1, help="""Width of
+            length histogram bins [default: %(default)s]""")
+    parser.add_argument('--sample', action='store_true', help="""Estimate
+            summaries of FASTA and FASTQ files from evenly spaced byte
+            ranges, rather than reading whole files. The number of sequences
+            is estimated from the bytes per record, and 95%% confidence bounds
+            are given for the number of sequences and average length. Minimum
+            and maximum lengths, the alignment flag and --stats are computed
+            over the sampled records; histogram counts are scaled to the
+            estimated number of sequences. Small files, and files with too
+            few complete records in the sample, are read in full.""")
+    parser.add_argument('--sample-blocks', metavar='N',
+            type=common.positive_value(int), default=DEFAULT_SAMPLE_BLOCKS,
+            help="""Number of byte ranges read from each file with --sample
+            [default: %(default)s]""")
+    parser.add_argument('--sample-block-size', metavar='BYTES',
+            type=common.positive_value(int), default=DEFAULT_SAMPLE_BLOCK_SIZE,
+            help="""Size of each byte range read with --sample [default:
+            %(default)s]""")
+    parser.add_argument('--per-record', action='store_true', help="""Write
+            one row per record rather than per file: the file name, record
+            ID, length, ungapped length, GC content of unambiguous
+            nucleotides, and the number of Ns and of gaps. Rows are written
+            as each file is read, tab-delimited unless --format csv is
+            given.""")
+    parser.add_argument('--cache', metavar='FILE', help="""SQLite database
+            of file summaries to reuse. Files whose path, size, modification
+            time and inode match a cached summary are not read; new summaries
+            are added. [default: no cache]""")
+    parser.add_argument('--refresh-cache', action='store_true',
+            help="""Summarize every file, replacing any cached summaries
+            (requires --cache)""")
+    parser.add_argument('-j', '--jobs', metavar='N',
+            type=common.positive_value(int), default=1, help="""Number of
+            files to summarize concurrently. Rows are written in argument
+            order. [default: %(default)s]""")
+    parser.add_argument('--thread-pool', action='store_true',
+            help="""Summarize files with a pool of threads rather than
+            processes. Requires --jobs greater than 1. Suited to files on
+            slow or network storage, where most time is spent waiting for
+            I/O.""")
 
 class SeqInfoWriter(object):
     """
     Base writer for sequence files
     """
 
-    def __init__(self, sequence_files, output, input_format=None):
+    def __init__(self, sequence_files, output, input_format=None, jobs=1,
+            threads=False, extended=False, histogram_out=None,
+            histogram_width=1, cache=None, refresh_cache=False, sample=None,
+            sample_block_size=DEFAULT_SAMPLE_BLOCK_SIZE):
         self.sequence_files = sequence_files
         self.output = output
         self.input_format = input_format
+        self.jobs = jobs
+        self.threads = threads
+        self.extended = extended
+        self.histogram_out = histogram_out
+        self.histogram_width = histogram_width
+        self.cache = cache
+        self.refresh_cache = refresh_cache
+        self.sample = sample
+        self.sample_block_size = sample_block_size
 
     def write_row(self, row):
         raise NotImplementedError("Override in subclass")
@@ -43,47 +129,92 @@ class SeqInfoWriter(object):
     def write_header(self, header):
         self.write_row(header)
 
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def write_records(self):
+        """
+        Write a row for each record in each file
+        """
+        self.write_header(_RECORD_HEADERS)
+        for source_file in self.sequence_files:
+            for ids, table in _record_batches(source_file, self.input_format):
+                self.write_rows(_record_rows(source_file, ids, table))
+
     def write(self):
-        header = ('name', 'alignment', 'min_len', 'max_len', 'avg_len',
-                  'num_seqs')
+        header = (_HEADERS + (_EXTENDED_HEADERS if self.extended else ()) +
+                  (_SAMPLE_HEADERS if self.sample else ()))
         self.write_header(header)
-        rows = (summarize_sequence_file(source_file, self.input_format)
-                for source_file in self.sequence_files)
 
-        for row in rows:
+        histogram_writer = None
+        histogram_width = None
+        if self.histogram_out is not None:
+            histogram_writer = csv.writer(self.histogram_out,
+                    delimiter='\t', lineterminator='\n')
+            histogram_writer.writerow(('name', 'min_len', 'max_len',
+                'count'))
+            histogram_width = self.histogram_width
+
+        results = summarize_sequence_files(self.sequence_files,
+                self.input_format, self.jobs, self.threads, self.extended,
+                histogram_width, self.cache, self.refresh_cache, self.sample,
+                self.sample_block_size)
+
+        for row, histogram in results:
             self.write_row(row)
+            if histogram_writer is not None:
+                histogram_writer.writerows((row.name,) + b for b in histogram)
 
 class CsvSeqInfoWriter(SeqInfoWriter):
     delimiter = ','
-    def __init__(self, sequence_files, output, input_format=None):
+    def __init__(self, sequence_files, output, input_format=None, **kwargs):
         super(CsvSeqInfoWriter, self).__init__(sequence_files, output,
-                input_format)
+                input_format, **kwargs)
         self.writer = csv.writer(self.output, delimiter=self.delimiter,
                 lineterminator='\n')
 
     def write_row(self, row):
         # To cope with header
         if hasattr(row, '_replace'):
-            row = row._replace(avg_len='{0:.2f}'.format(row.avg_len))
+            row = row._replace(**dict(
+                (field, fmt.format(getattr(row, field)))
+                for field, fmt in _FLOAT_FORMATS.iteritems()
+                if hasattr(row, field)))
         self.writer.writerow(row)
 
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
 class TsvSeqInfoWriter(CsvSeqInfoWriter):
     delimiter = '\t'
 
 class AlignedSeqInfoWriter(SeqInfoWriter):
-    def __init__(self, sequence_files, output, input_format=None):
+    def __init__(self, sequence_files, output, input_format=None, **kwargs):
         super(AlignedSeqInfoWriter, self).__init__(sequence_files, output,
-                input_format)
+                input_format, **kwargs)
         self.max_name_length = max(len(f) for f in self.sequence_files)
 
     def write_header(self, header):
         fmt = ('{0:' + str(self.max_name_length + 1) + 's}{1:10s}'
                 '{2:>10s}{3:>10s}{4:>10s}{5:>10s}')
+        if self.extended:
+            fmt += '{6:>14s}{7:>10s}{8:>10s}{9:>10s}{10:>10s}{11:>10s}'
+        if self.sample:
+            i = len(header) - len(_SAMPLE_HEADERS)
+            fmt += ('{%d:>14s}{%d:>14s}{%d:>14s}{%d:>14s}' %
+                    tuple(xrange(i, i + 4)))
         print >> self.output, fmt.format(*header)
 
     def write_row(self, row):
         fmt = ('{name:' + str(self.max_name_length + 1) + 's}{alignment:10s}'
                 '{min_len:10d}{max_len:10d}{avg_len:10.2f}{num_seqs:10d}')
+        if self.extended:
+            fmt += ('{total_len:14d}{n50:10d}{n90:10d}{gc:10.4f}'
+                    '{ambiguous:10.4f}{gaps:10.4f}')
+        if self.sample:
+            fmt += ('{num_seqs_low:14d}{num_seqs_high:14d}'
+                    '{avg_len_low:14.2f}{avg_len_high:14.2f}')
         print >> self.output, fmt.format(**row._asdict())
 
 
@@ -92,52 +223,815 @@ _WRITERS = {'csv': CsvSeqInfoWriter, 'tab': TsvSeqInfoWriter, 'align':
 
 _HEADERS = ('name', 'alignment', 'min_len', 'max_len', 'avg_len',
               'num_seqs')
-_SeqFileInfo = collections.namedtuple('SeqFileInfo', _HEADERS)
+_EXTENDED_HEADERS = ('total_len', 'n50', 'n90', 'gc', 'ambiguous', 'gaps')
+_SAMPLE_HEADERS = ('num_seqs_low', 'num_seqs_high', 'avg_len_low',
+                   'avg_len_high')
+# Named to match their module attributes, so results can be pickled with
+# --jobs
+_SeqFileInfo = collections.namedtuple('_SeqFileInfo', _HEADERS)
+_ExtendedSeqFileInfo = collections.namedtuple('_ExtendedSeqFileInfo',
+        _HEADERS + _EXTENDED_HEADERS)
+_SampledSeqFileInfo = collections.namedtuple('_SampledSeqFileInfo',
+        _HEADERS + _SAMPLE_HEADERS)
+_ExtendedSampledSeqFileInfo = collections.namedtuple(
+        '_ExtendedSampledSeqFileInfo',
+        _HEADERS + _EXTENDED_HEADERS + _SAMPLE_HEADERS)
+
+# Row classes, by whether extended and sampled
+_ROW_CLASSES = {(False, False): _SeqFileInfo,
+                (True, False): _ExtendedSeqFileInfo,
+                (False, True): _SampledSeqFileInfo,
+                (True, True): _ExtendedSampledSeqFileInfo}
+
+# Formats for floating point fields in delimited output
+_FLOAT_FORMATS = {'avg_len': '{0:.2f}', 'gc': '{0:.4f}',
+                  'ambiguous': '{0:.4f}', 'gaps': '{0:.4f}',
+                  'avg_len_low': '{0:.2f}', 'avg_len_high': '{0:.2f}'}
+
+# Residues counted towards GC content, and the unambiguous residues
+_GC_RESIDUES = numpy.array([ord(c) for c in 'CGcg'])
+_UNAMBIGUOUS_RESIDUES = numpy.array([ord(c) for c in 'ACGTUacgtu'])
+_GAP_RESIDUES = numpy.array([ord(c) for c in '-.'])
 
 
-def summarize_sequence_file(source_file, file_type=None):
+class _UnsupportedLayout(Exception):
     """
-    Summarizes a sequence file, returning a tuple containing the name,
-    whether the file is an alignment, minimum sequence length, maximum
-    sequence length, average length, number of sequences.
+    Raised when a file can't be summarized without parsing each record
+    """
+    pass
+
+def _read_lines_block(handle, block_size, lines_multiple=1):
+    """
+    Read a block of about block_size bytes, ending at the end of a line. If
+    lines_multiple is greater than one, the block is extended to contain a
+    multiple of that many lines.
+
+    Returns the block, and arrays of the start and end (excluding newline)
+    of each line.
+    """
+    block = handle.read(block_size)
+    if not block:
+        return block, None, None
+    if not block.endswith('\n'):
+        block += handle.readline()
+    if lines_multiple > 1:
+        block += ''.join(handle.readline() for _ in
+                         xrange(-block.count('\n') % lines_multiple))
+    if not block.endswith('\n'):
+        # Final line without a newline
+        block += '\n'
+    ends = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) ==
+                             ord('\n'))
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    return block, starts, ends
+
+def _line_counts(block, starts, ends, characters):
+    """
+    Count the bytes of each line in block which are any of characters.
+    """
+    data = numpy.frombuffer(block, dtype=numpy.uint8)
+    matches = data == ord(characters[0])
+    for c in characters[1:]:
+        matches |= data == ord(c)
+    # Usually rare, so count by position rather than over every byte
+    positions = numpy.flatnonzero(matches)
+    return (numpy.searchsorted(positions, ends) -
+            numpy.searchsorted(positions, starts))
+
+def _byte_counts(block, starts, ends):
+    """
+    Count the occurrences of each byte value within the lines of block given
+    by starts and ends.
+
+    Returns an array of 256 counts.
+    """
+    data = numpy.frombuffer(block, dtype=numpy.uint8)
+    # +1 at the start of each line, -1 at its end, so the cumulative sum is
+    # positive within the lines. Lines don't overlap, so no index repeats
+    # within starts or ends.
+    markers = numpy.zeros(len(data) + 1, dtype=numpy.int8)
+    markers[starts] += 1
+    markers[ends] -= 1
+    in_lines = numpy.cumsum(markers[:-1], dtype=numpy.int8).view(numpy.bool_)
+    return numpy.bincount(data[in_lines], minlength=256)
+
+def _fasta_blocks(handle, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Generate (block, starts, ends, line_lengths, is_header) tuples for blocks
+    of lines in a FASTA file, where line_lengths excludes spaces and carriage
+    returns, matching Bio.SeqIO, and is zero for header lines.
+
+    Raises _UnsupportedLayout if the file contains other whitespace within
+    lines.
+    """
+    while True:
+        block, starts, ends = _read_lines_block(handle, block_size)
+        if not block:
+            break
+        if '\t' in block or '\x0b' in block or '\x0c' in block:
+            raise _UnsupportedLayout()
+
+        line_lengths = (ends - starts) - _line_counts(block, starts, ends,
+                                                      ' \r')
+        is_header = numpy.frombuffer(block, dtype=numpy.uint8)[starts] == \
+                ord('>')
+        line_lengths[is_header] = 0
+        yield block, starts, ends, line_lengths, is_header
+
+def _fasta_lengths(handle, block_size=DEFAULT_BLOCK_SIZE, composition=False):
+    """
+    Generate (lengths, counts) tuples for the records in a FASTA file,
+    counting the sequence bytes between header lines block by block. lengths
+    is an array of record lengths; if composition is true, counts is an array
+    of the number of occurrences of each byte value in the sequences,
+    otherwise None.
+
+    Spaces and carriage returns are not counted, matching Bio.SeqIO. Raises
+    _UnsupportedLayout if the file contains other whitespace within lines.
+    """
+    # Length of the record being read; None before the first header
+    current = None
+    for block, starts, ends, line_lengths, is_header in _fasta_blocks(
+            handle, block_size):
+        headers = numpy.flatnonzero(is_header)
+
+        counts = None
+        if composition:
+            # Text before the first header is ignored
+            sequence_lines = ~is_header
+            if current is None:
+                sequence_lines[:headers[0] if len(headers) else None] = False
+            counts = _byte_counts(block, starts[sequence_lines],
+                                  ends[sequence_lines])
+            counts[[ord(' '), ord('\r')]] = 0
+
+        if not len(headers):
+            if current is not None:
+                current += int(line_lengths.sum())
+            if counts is not None:
+                yield numpy.array([], dtype=int), counts
+            continue
+
+        lengths = numpy.add.reduceat(line_lengths, headers)
+        if current is not None:
+            current += int(line_lengths[:headers[0]].sum())
+            yield numpy.array([current]), None
+        yield lengths[:-1], counts
+        current = int(lengths[-1])
+
+    if current is not None:
+        yield numpy.array([current]), None
+
+def _fastq_blocks(handle, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Generate (block, starts, lengths) tuples for blocks of records in a
+    FASTQ file, where starts are the start of each line, and lengths the
+    length of each record.
+
+    Only files with four lines per record are supported: _UnsupportedLayout
+    is raised for anything else, such as sequences split over several lines.
+    Captions are not checked.
+    """
+    while True:
+        block, starts, ends = _read_lines_block(handle, block_size, 4)
+        if not block:
+            break
+        if len(starts) % 4:
+            raise _UnsupportedLayout()
+        data = numpy.frombuffer(block, dtype=numpy.uint8)
+        if ((data[starts[0::4]] != ord('@')).any() or
+                (data[starts[2::4]] != ord('+')).any()):
+            raise _UnsupportedLayout()
+
+        # Only a trailing carriage return is allowed in sequence and quality
+        # lines
+        line_lengths = ends - starts
+        trailing_cr = (data[ends - 1] == ord('\r')) & (line_lengths > 0)
+        whitespace = _line_counts(block, starts, ends, ' \t\r\x0b\x0c')
+        data_lines = numpy.arange(len(starts)) % 2 == 1
+        if (whitespace[data_lines] != trailing_cr[data_lines]).any():
+            raise _UnsupportedLayout()
+
+        line_lengths -= trailing_cr
+        lengths = line_lengths[1::4]
+        if (lengths != line_lengths[3::4]).any():
+            raise _UnsupportedLayout()
+        yield block, starts, lengths
+
+def _fastq_lengths(handle, block_size=DEFAULT_BLOCK_SIZE, composition=False):
+    """
+    Generate (lengths, counts) tuples for the records in a FASTQ file, block
+    by block, as for _fasta_lengths.
+
+    Raises _UnsupportedLayout for files without four lines per record.
+    """
+    for block, starts, lengths in _fastq_blocks(handle, block_size):
+        counts = None
+        if composition:
+            counts = _byte_counts(block, starts[1::4],
+                                  starts[1::4] + lengths)
+        yield lengths, counts
+
+# Functions generating record lengths and composition without parsing
+# records, by file type
+_SCANNERS = {'fasta': _fasta_lengths,
+             'fastq': _fastq_lengths,
+             'fastq-sanger': _fastq_lengths,
+             'fastq-illumina': _fastq_lengths,
+             'fastq-solexa': _fastq_lengths}
+
+_RECORD_HEADERS = ('name', 'id', 'length', 'ungapped_length', 'gc',
+                   'n_count', 'gap_count')
+
+# Residues counted for each record, after its length, in the tables
+# generated by _record_batches
+_RECORD_RESIDUES = ('CGcg', 'ACGTUacgtu', 'Nn', '-.')
+
+def _residue_flags():
+    """
+    Bit flags for each byte value, with bit i set for residues in
+    _RECORD_RESIDUES[i]
+    """
+    flags = numpy.zeros(256, dtype=numpy.uint8)
+    for bit, residues in enumerate(_RECORD_RESIDUES):
+        flags[[ord(c) for c in residues]] |= 1 << bit
+    return flags
+_RESIDUE_FLAGS = _residue_flags()
+
+def _residue_counts(block, starts, ends):
+    """
+    Count the residues in each of _RECORD_RESIDUES within the lines of block
+    given by starts and ends, returning a list of arrays.
+    """
+    flags = _RESIDUE_FLAGS[numpy.frombuffer(block, dtype=numpy.uint8)]
+    # Most bytes are residues, so sum over each line rather than counting by
+    # position as in _line_counts. reduceat sums from each start to the next
+    # index, so alternate starts and ends, and take every other sum.
+    indices = numpy.empty(2 * len(starts), dtype=numpy.intp)
+    indices[0::2] = starts
+    indices[1::2] = ends
+    # reduceat gives the element at the index for empty ranges
+    empty = starts == ends
+    # Narrower sums are faster
+    dtype = numpy.int32 if len(flags) < 1 << 31 else numpy.int64
+    result = []
+    for bit in xrange(len(_RECORD_RESIDUES)):
+        counts = numpy.add.reduceat((flags >> bit) & 1, indices,
+                                    dtype=dtype)[0::2]
+        counts[empty] = 0
+        result.append(counts)
+    return result
+
+def _record_id(title):
+    """
+    The ID of a record from its title, as Bio.SeqIO
+    """
+    return title.split(None, 1)[0] if title.strip() else ''
+
+def _fasta_record_counts(handle, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Generate (ids, table) tuples for the records in a FASTA file, block by
+    block, where table is an array with a row for each record, and columns
+    for its length and number of each of _RECORD_RESIDUES.
+    """
+    # ID and counts of the record being read; None before the first header
+    current_id, current = None, None
+    for block, starts, ends, line_lengths, is_header in _fasta_blocks(
+            handle, block_size):
+        table = numpy.column_stack([line_lengths] +
+                                   _residue_counts(block, starts, ends))
+        table[is_header] = 0
+        headers = numpy.flatnonzero(is_header)
+
+        if not len(headers):
+            if current is not None:
+                current += table.sum(axis=0)
+            continue
+
+        ids = [_record_id(block[start + 1:end]) for start, end in
+               itertools.izip(starts[headers], ends[headers])]
+        records = numpy.add.reduceat(table, headers)
+        if current is not None:
+            current += table[:headers[0]].sum(axis=0)
+            yield [current_id], current[numpy.newaxis]
+        yield ids[:-1], records[:-1]
+        current_id, current = ids[-1], records[-1].copy()
+
+    if current is not None:
+        yield [current_id], current[numpy.newaxis]
+
+def _fastq_record_counts(handle, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Generate (ids, table) tuples for the records in a FASTQ file, block by
+    block, as for _fasta_record_counts.
+    """
+    for block, starts, lengths in _fastq_blocks(handle, block_size):
+        sequence_starts = starts[1::4]
+        sequence_ends = sequence_starts + lengths
+        table = numpy.column_stack([lengths] + _residue_counts(block,
+                sequence_starts, sequence_ends))
+        ids = [_record_id(block[start + 1:end - 1]) for start, end in
+               itertools.izip(starts[0::4], starts[1::4])]
+        yield ids, table
+
+# Functions generating per-record counts without parsing records, by file
+# type
+_RECORD_SCANNERS = {'fasta': _fasta_record_counts,
+                    'fastq': _fastq_record_counts,
+                    'fastq-sanger': _fastq_record_counts,
+                    'fastq-illumina': _fastq_record_counts,
+                    'fastq-solexa': _fastq_record_counts}
+
+def _record_batches(source_file, file_type=None, batch_size=1000):
+    """
+    Generate (ids, table) tuples for the records in a sequence file, as for
+    _fasta_record_counts.
+
+    FASTA and FASTQ files are scanned without parsing records where possible.
+    If a layout the scanner doesn't support is found partway through a file,
+    the remaining records are parsed with Bio.SeqIO.
     """
-    is_alignment = True
-    avg_length = None
-    min_length = sys.maxint
-    max_length = 0
-    sequence_count = 0
     if not file_type:
         file_type = fileformat.from_filename(source_file)
 
-    # Get an iterator and analyze the data.
-    for record in SeqIO.parse(source_file, file_type):
-        sequence_count += 1
-        sequence_length = len(record)
-        if max_length != 0:
-            # If even one sequence is not the same length as the others,
-            # we don't consider this an alignment.
-            if sequence_length != max_length:
-                is_alignment = False
-
-        # Lengths
-        if sequence_length > max_length:
-            max_length = sequence_length
-        if sequence_length < min_length:
-            min_length = sequence_length
-
-        # Average length
-        if sequence_count == 1:
-            avg_length = float(sequence_length)
+    scanned = 0
+    scanner = _RECORD_SCANNERS.get(file_type)
+    if scanner:
+        try:
+            with open(source_file, 'rb') as fp:
+                for ids, table in scanner(fp):
+                    yield ids, table
+                    scanned += len(ids)
+            return
+        except _UnsupportedLayout:
+            pass
+
+    residue_indexes = [numpy.array([ord(c) for c in residues])
+                       for residues in _RECORD_RESIDUES]
+    records = itertools.islice(SeqIO.parse(source_file, file_type), scanned,
+                               None)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        table = numpy.zeros((len(batch), len(_RECORD_RESIDUES) + 1),
+                            dtype=numpy.int64)
+        for i, record in enumerate(batch):
+            counts = numpy.bincount(numpy.frombuffer(str(record.seq),
+                dtype=numpy.uint8), minlength=256)
+            table[i] = [len(record)] + [counts[index].sum()
+                                        for index in residue_indexes]
+        yield [record.id for record in batch], table
+
+def _record_rows(source_file, ids, table):
+    """
+    Rows of _RECORD_HEADERS fields from a table of per-record counts
+    """
+    lengths, gc, unambiguous, ns, gaps = table.T
+    gc_content = gc / numpy.maximum(unambiguous, 1).astype(float)
+    return itertools.izip(itertools.repeat(source_file), ids,
+            lengths.tolist(), (lengths - gaps).tolist(),
+            ['{0:.4f}'.format(i) for i in gc_content.tolist()],
+            ns.tolist(), gaps.tolist())
+
+class _SequenceStats(object):
+    """
+    Accumulates statistics over arrays of sequence lengths and residue
+    counts.
+
+    If track_lengths is true, the number of sequences of each distinct length
+    is kept, as a pair of arrays, for N50/N90 and length histograms.
+    """
+    def __init__(self, track_lengths=False):
+        self.min_length = sys.maxint
+        self.max_length = 0
+        self.total_length = 0
+        self.sequence_count = 0
+        self.residue_counts = numpy.zeros(256, dtype=numpy.int64)
+        self.track_lengths = track_lengths
+        self.lengths = numpy.array([], dtype=numpy.int64)
+        self.length_counts = numpy.array([], dtype=numpy.int64)
+
+    def add(self, lengths, counts=None):
+        if counts is not None:
+            self.residue_counts += counts
+        if not len(lengths):
+            return
+        self.sequence_count += len(lengths)
+        self.total_length += int(lengths.sum())
+        self.min_length = min(self.min_length, int(lengths.min()))
+        self.max_length = max(self.max_length, int(lengths.max()))
+
+        if self.track_lengths:
+            values, counts = numpy.unique(lengths, return_counts=True)
+            values = numpy.concatenate((self.lengths, values))
+            counts = numpy.concatenate((self.length_counts, counts))
+            self.lengths, index = numpy.unique(values, return_inverse=True)
+            self.length_counts = numpy.zeros(len(self.lengths),
+                                             dtype=numpy.int64)
+            numpy.add.at(self.length_counts, index, counts)
+
+    def nx(self, proportion):
+        """
+        The length L such that sequences of length L or longer contain at
+        least proportion of the total length, e.g. N50 for 0.5.
+        """
+        if not self.total_length:
+            return 0
+        # Longest first
+        lengths = self.lengths[::-1]
+        cumulative = numpy.cumsum(lengths * self.length_counts[::-1])
+        i = numpy.searchsorted(cumulative, proportion * self.total_length)
+        return int(lengths[i])
+
+    def histogram(self, width):
+        """
+        Returns a list of (min_len, max_len, count) tuples for bins of width
+        lengths containing sequences.
+        """
+        bins, index = numpy.unique(self.lengths // width, return_inverse=True)
+        counts = numpy.zeros(len(bins), dtype=numpy.int64)
+        numpy.add.at(counts, index, self.length_counts)
+        return [(int(b) * width, (int(b) + 1) * width - 1, int(c))
+                for b, c in zip(bins, counts)]
+
+    def row(self, source_file, extended=False):
+        # Handle an empty file:
+        if not self.sequence_count:
+            row = (source_file, 'TRUE', 0, 0, 0, 0)
         else:
-            avg_length = avg_length + ((sequence_length - avg_length) /
-                                       sequence_count)
+            # If even one sequence is not the same length as the others, we
+            # don't consider this an alignment.
+            is_alignment = self.min_length == self.max_length
+            row = (source_file, str(is_alignment).upper(), self.min_length,
+                   self.max_length,
+                   float(self.total_length) / self.sequence_count,
+                   self.sequence_count)
+        if not extended:
+            return _SeqFileInfo(*row)
+
+        residue_counts = self.residue_counts
+        gaps = int(residue_counts[_GAP_RESIDUES].sum())
+        residues = self.total_length - gaps
+        unambiguous = int(residue_counts[_UNAMBIGUOUS_RESIDUES].sum())
+        gc = int(residue_counts[_GC_RESIDUES].sum())
+
+        def fraction(numerator, denominator):
+            return float(numerator) / denominator if denominator else 0.0
 
-    # Handle an empty file:
-    if avg_length is None:
-        min_length = max_length = avg_length = 0
+        return _ExtendedSeqFileInfo(*row + (self.total_length,
+            self.nx(0.5), self.nx(0.9), fraction(gc, unambiguous),
+            fraction(residues - unambiguous, residues),
+            fraction(gaps, self.total_length)))
 
-    return _SeqFileInfo(source_file, str(is_alignment).upper(), min_length,
-            max_length, avg_length, sequence_count)
+def _fasta_records(handle, block, max_size):
+    """
+    Return the FASTA records starting in block, reading the rest of the final
+    record from handle.
+
+    Raises _UnsupportedLayout if the final record continues for more than
+    max_size bytes past the block.
+    """
+    if block.startswith('>'):
+        start = 0
+    else:
+        start = block.find('\n>') + 1
+        if not start:
+            return ''
+    rest = []
+    remaining = max_size
+    for line in iter(handle.readline, ''):
+        if line.startswith('>'):
+            break
+        rest.append(line)
+        remaining -= len(line)
+        if remaining < 0:
+            raise _UnsupportedLayout()
+    return block[start:] + ''.join(rest)
+
+def _fastq_records(handle, block, max_size):
+    """
+    Return the four-line FASTQ records starting in block, reading the rest of
+    the final record from handle.
+
+    Raises _UnsupportedLayout if no record start is found in the first few
+    lines.
+    """
+    lines = block.split('\n')
+    lines.pop()
+    window_lines = len(lines)
+    # '@' may also start a quality line, so check for a complete record,
+    # using lines past the block
+    lines.extend(line.rstrip('\n') for line in
+                 (handle.readline() for _ in xrange(4)) if line)
+    for i in xrange(min(4, len(lines) - 3)):
+        title, sequence, plus, quality = lines[i:i + 4]
+        if (title.startswith('@') and plus.startswith('+') and
+                len(sequence.rstrip('\r')) == len(quality.rstrip('\r')) and
+                (i + 4 == len(lines) or lines[i + 4].startswith('@'))):
+            break
+    else:
+        if len(lines) < 8:
+            return ''
+        raise _UnsupportedLayout()
+
+    end = i + (window_lines - i + 3) // 4 * 4
+    if end > len(lines):
+        # Incomplete record at the end of the file
+        end -= 4
+    return ''.join(line + '\n' for line in lines[i:end])
+
+# Functions reading sampled records, by file type
+_RECORD_READERS = {'fasta': _fasta_records,
+                   'fastq': _fastq_records,
+                   'fastq-sanger': _fastq_records,
+                   'fastq-illumina': _fastq_records,
+                   'fastq-solexa': _fastq_records}
+
+def _sampled_blocks(handle, size, blocks, block_size, read_records):
+    """
+    Generate (window size, records) tuples for evenly spaced windows of
+    block_size bytes in handle, where records are the complete records
+    starting in each window, as read by read_records.
+
+    Counting records by where they start, rather than records wholly within a
+    window, avoids favouring short records.
+    """
+    for i in xrange(blocks):
+        offset = i * size // blocks
+        handle.seek(max(offset - 1, 0))
+        if offset:
+            # Skip to the first line starting in the window
+            handle.readline()
+        block = handle.read(max(block_size - (handle.tell() - offset), 0))
+        if block:
+            if not block.endswith('\n'):
+                block += handle.readline()
+            if not block.endswith('\n'):
+                block += '\n'
+        yield (min(block_size, size - offset),
+               read_records(handle, block, 16 * block_size))
+
+def _ratio_bounds(numerators, denominators):
+    """
+    Estimate the ratio sum(numerators) / sum(denominators) from per-block
+    samples, returning (estimate, low, high), where low and high are
+    approximate 95% confidence bounds.
+    """
+    numerators = numpy.asarray(numerators, dtype=float)
+    denominators = numpy.asarray(denominators, dtype=float)
+    n = len(numerators)
+    ratio = numerators.sum() / denominators.sum()
+    residuals = numerators - ratio * denominators
+    variance = (residuals ** 2).sum() / (n - 1) / n
+    error = _Z_95 * math.sqrt(variance) / denominators.mean()
+    return ratio, ratio - error, ratio + error
+
+def _summarize_sample(source_file, file_type, extended, histogram_width,
+        blocks, block_size):
+    """
+    Estimate the summary of a FASTA or FASTQ file from a sample of blocks,
+    returning a (row, histogram) tuple, or None if the file should be read in
+    full.
+    """
+    size = os.path.getsize(source_file)
+    if size <= blocks * block_size:
+        return None
+
+    scanner = _SCANNERS[file_type]
+    read_records = _RECORD_READERS[file_type]
+    stats = _SequenceStats(extended or histogram_width is not None)
+    block_bytes, block_records, block_lengths = [], [], []
+    with open(source_file, 'rb') as fp:
+        for window, records in _sampled_blocks(fp, size, blocks, block_size,
+                                               read_records):
+            count = total = 0
+            for lengths, counts in scanner(StringIO(records),
+                    len(records) + 1, composition=extended):
+                stats.add(lengths, counts)
+                count += len(lengths)
+                total += int(lengths.sum())
+            block_bytes.append(window)
+            block_records.append(count)
+            block_lengths.append(total)
+
+    # Require complete records in at least two blocks for bounds
+    if sum(1 for count in block_records if count) < 2:
+        return None
+
+    per_byte, per_byte_low, per_byte_high = _ratio_bounds(block_records,
+                                                          block_bytes)
+    avg_length, avg_length_low, avg_length_high = _ratio_bounds(
+            block_lengths, block_records)
+    sequence_count = int(round(per_byte * size))
+    row = stats.row(source_file, extended)
+    row = _ROW_CLASSES[extended, True](*row + (
+        max(int(math.floor(per_byte_low * size)), stats.sequence_count),
+        int(math.ceil(per_byte_high * size)),
+        max(avg_length_low, 0.0), avg_length_high))
+    row = row._replace(num_seqs=sequence_count, avg_len=avg_length)
+    if extended:
+        row = row._replace(total_len=int(round(avg_length * sequence_count)))
+
+    histogram = None
+    if histogram_width is not None:
+        scale = float(sequence_count) / stats.sequence_count
+        histogram = [(low, high, int(round(count * scale)))
+                     for low, high, count in stats.histogram(histogram_width)]
+    return row, histogram
+
+def _summarize(source_file, file_type=None, extended=False,
+        histogram_width=None, sample=None,
+        sample_block_size=DEFAULT_SAMPLE_BLOCK_SIZE):
+    """
+    Summarize a sequence file, returning a (row, histogram) tuple. histogram
+    is None unless histogram_width is given.
+
+    If sample is given, FASTA and FASTQ files are summarized from sample
+    blocks of sample_block_size bytes where possible.
+    """
+    if not file_type:
+        file_type = fileformat.from_filename(source_file)
+
+    def summarize(batches):
+        stats = _SequenceStats(extended or histogram_width is not None)
+        for lengths, counts in batches:
+            stats.add(lengths, counts)
+        histogram = None
+        if histogram_width is not None:
+            histogram = stats.histogram(histogram_width)
+        row = stats.row(source_file, extended)
+        if sample:
+            # Exact, so the bounds are the values
+            row = _ROW_CLASSES[extended, True](*row + (row.num_seqs,
+                row.num_seqs, row.avg_len, row.avg_len))
+        return row, histogram
+
+    scanner = _SCANNERS.get(file_type)
+    if scanner and sample:
+        try:
+            result = _summarize_sample(source_file, file_type, extended,
+                    histogram_width, sample, sample_block_size)
+            if result is not None:
+                return result
+        except _UnsupportedLayout:
+            pass
+    if scanner:
+        try:
+            with open(source_file, 'rb') as fp:
+                return summarize(scanner(fp, composition=extended))
+        except _UnsupportedLayout:
+            pass
+
+    def bio_batches():
+        for record in SeqIO.parse(source_file, file_type):
+            counts = None
+            if extended:
+                counts = numpy.bincount(numpy.frombuffer(str(record.seq),
+                    dtype=numpy.uint8), minlength=256)
+            yield numpy.array([len(record)]), counts
+    return summarize(bio_batches())
+
+def summarize_sequence_file(source_file, file_type=None, extended=False):
+    """
+    Summarizes a sequence file, returning a tuple containing the name,
+    whether the file is an alignment, minimum sequence length, maximum
+    sequence length, average length, number of sequences. If extended is
+    true, the total length, N50, N90, GC content, ambiguous residue fraction
+    and gap fraction follow.
+
+    FASTA and FASTQ files are scanned without parsing records where possible;
+    other formats are parsed with Bio.SeqIO.
+    """
+    return _summarize(source_file, file_type, extended)[0]
+
+class SummaryCache(object):
+    """
+    Cache of file summaries in an SQLite database.
+
+    Summaries are keyed by absolute path and summary options, and are valid
+    while the size, modification time and inode of the file are unchanged.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS summaries (
+            path TEXT NOT NULL,
+            options TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            inode INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (path, options))""")
+
+    @staticmethod
+    def identity(source_file):
+        """
+        Returns an (absolute path, size, mtime, inode) tuple for source_file
+        """
+        st = os.stat(source_file)
+        return (os.path.abspath(source_file), st.st_size, st.st_mtime,
+                st.st_ino)
+
+    def get(self, identity, options):
+        """
+        Returns the cached result for identity and options, or None if there
+        is no result or the file has changed.
+        """
+        path, size, mtime, inode = identity
+        cached = self.connection.execute("""SELECT size, mtime, inode, result
+            FROM summaries WHERE path = ? AND options = ?""",
+            (path, options)).fetchone()
+        if cached is None or tuple(cached[:3]) != (size, mtime, inode):
+            return None
+        return json.loads(cached[3])
+
+    def put(self, identity, options, result):
+        path, size, mtime, inode = identity
+        self.connection.execute("""INSERT OR REPLACE INTO summaries
+            (path, options, size, mtime, inode, result)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (path, options, size, mtime, inode, json.dumps(result)))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def _imap(function, items, jobs=1, threads=False):
+    """
+    Apply function to items, yielding results in order. If jobs is greater
+    than one, items are processed concurrently by a pool of jobs processes,
+    or threads if threads is true.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    pool_cls = (multiprocessing.pool.ThreadPool if threads
+                else multiprocessing.Pool)
+    pool = pool_cls(min(jobs, len(items)))
+    try:
+        for result in pool.imap(function, items):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def summarize_sequence_files(source_files, file_type=None, jobs=1,
+        threads=False, extended=False, histogram_width=None, cache=None,
+        refresh_cache=False, sample=None,
+        sample_block_size=DEFAULT_SAMPLE_BLOCK_SIZE):
+    """
+    Summarize each of source_files as summarize_sequence_file does, yielding
+    (row, histogram) tuples in the order of source_files. histogram is a list
+    of (min_len, max_len, count) tuples if histogram_width is given,
+    otherwise None.
+
+    If jobs is greater than one, files are summarized concurrently by a pool
+    of jobs processes, or threads if threads is true.
+
+    If a SummaryCache is given, cached summaries of unchanged files are used
+    unless refresh_cache is true, and new summaries are added to it.
+
+    If sample is given, summaries are estimated from sample blocks of
+    sample_block_size bytes where possible; see _summarize_sample.
+    """
+    summarize = functools.partial(_summarize, file_type=file_type,
+            extended=extended, histogram_width=histogram_width,
+            sample=sample, sample_block_size=sample_block_size)
+    if cache is None:
+        for result in _imap(summarize, source_files, jobs, threads):
+            yield result
+        return
+
+    options = json.dumps([_CACHE_VERSION, file_type, extended,
+                          histogram_width, sample,
+                          sample_block_size if sample else None])
+    row_cls = _ROW_CLASSES[extended, bool(sample)]
+    identities = [cache.identity(f) for f in source_files]
+    results = [None] * len(source_files)
+    if not refresh_cache:
+        for i, (source_file, identity) in enumerate(zip(source_files,
+                                                        identities)):
+            cached = cache.get(identity, options)
+            if cached is not None:
+                row, histogram = cached
+                row = row_cls(source_file, *row[1:])
+                if histogram is not None:
+                    histogram = [tuple(b) for b in histogram]
+                results[i] = row, histogram
+
+    missing = [f for f, result in zip(source_files, results)
+               if result is None]
+    summaries = _imap(summarize, missing, jobs, threads)
+    for identity, result in zip(identities, results):
+        if result is None:
+            result = next(summaries)
+            cache.put(identity, options, result)
+        yield result
 
 def action(arguments):
     """
@@ -152,14 +1046,47 @@ def action(arguments):
 
     handle = arguments.destination_file
     output_format = arguments.output_format
+    if arguments.per_record:
+        conflicts = [option for option, value in (
+            ('--format align', output_format == 'align'),
+            ('--stats', arguments.stats),
+            ('--length-histogram', arguments.length_histogram),
+            ('--sample', arguments.sample),
+            ('--cache', arguments.cache),
+            ('--jobs', arguments.jobs > 1)) if value]
+        if conflicts:
+            raise ValueError("--per-record is not supported with " +
+                             ', '.join(conflicts))
+        output_format = output_format or 'tab'
     if not output_format:
         try:
             output_format = 'align' if handle.isatty() else 'tab'
         except AttributeError:
             output_format = 'tab'
 
+    if arguments.refresh_cache and not arguments.cache:
+        raise ValueError("--refresh-cache specified without --cache")
+    if arguments.thread_pool and arguments.jobs <= 1:
+        raise ValueError("--thread-pool requires --jobs greater than 1")
+    cache = None
+    if arguments.cache:
+        cache = SummaryCache(arguments.cache)
+
     writer_cls = _WRITERS[output_format]
     with handle:
         writer = writer_cls(arguments.source_files, handle,
-                arguments.input_format)
-        writer.write()
+                arguments.input_format, jobs=arguments.jobs,
+                threads=arguments.thread_pool, extended=arguments.stats,
+                histogram_out=arguments.length_histogram,
+                histogram_width=arguments.histogram_bin_width, cache=cache,
+                refresh_cache=arguments.refresh_cache,
+                sample=arguments.sample_blocks if arguments.sample else None,
+                sample_block_size=arguments.sample_block_size)
+        if arguments.per_record:
+            writer.write_records()
+        else:
+            writer.write()
+    if arguments.length_histogram:
+        arguments.length_histogram.close()
+    if cache is not None:
+        cache.close()
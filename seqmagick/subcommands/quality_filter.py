@@ -6,20 +6,60 @@ import argparse
 import collections
 import csv
 import itertools
+import multiprocessing
+import operator
 import re
 import sys
-from Queue import Queue, Empty
-import threading
+import timeit
 
 from Bio import SeqIO
-from Bio.SeqIO import QualityIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+import numpy
 
-from seqmagick import fileformat
-from .common import typed_range
+from seqmagick import fileformat, transform
+from .common import positive_value, quality_bins, typed_range
 
 # Default minimummean quality score
 DEFAULT_MEAN_SCORE = 25.0
 
+# Number of reads passed to a worker process at a time with --threads
+DEFAULT_CHUNK_SIZE = 1000
+
+# Number of failures buffered before writing to the failure report
+DEFAULT_FAILURE_BATCH_SIZE = 1000
+
+# Number of records buffered per output file before writing
+DEFAULT_WRITE_BUFFER_SIZE = 256
+
+# Default maximum number of per-sample output files open at once
+DEFAULT_MAX_OPEN_FILES = 64
+
+# Number of Phred scores tracked in quality profiles. Scores are converted to
+# bytes, so this covers every possible value.
+PROFILE_SCORES = 256
+
+# Initial number of positions in a quality profile
+DEFAULT_PROFILE_LENGTH = 500
+
+# Default number of reads used to choose a filter order with --reorder-filters
+DEFAULT_REORDER_SAMPLE_SIZE = 1000
+
+# Default maximum adapter mismatches + indels per aligned adapter base
+DEFAULT_ADAPTER_ERROR_RATE = 0.1
+
+# Default minimum number of adapter bases at the 3' end of a read to trim
+DEFAULT_ADAPTER_MIN_OVERLAP = 3
+
+# Probability that a base call is incorrect, indexed by Phred score
+_PHRED_ERROR_PROBABILITY = 10 ** (numpy.arange(PROFILE_SCORES) / -10.0)
+
+# Number of quality scores buffered before adding to a quality profile
+DEFAULT_PROFILE_BATCH_SIZE = 1 << 20
+
+# Formats which may be written to a file in several pieces
+_APPENDABLE_FORMATS = frozenset(('fasta', 'fastq', 'qual'))
+
 # Tools for working with ambiguous bases
 # Map from Ambiguous Base to regex
 _AMBIGUOUS_MAP = {
@@ -54,15 +94,71 @@ def build_parser(parser):
             help="""The quality scores associated with the input file. Only
             used if input file is fasta.""")
     parser.add_argument('output_file', type=argparse.FileType('w'),
-            help="""Output file. Format determined from extension.""")
+            help="""Output file. Format determined from extension. Use '-'
+            with --sweep-params, which writes passing reads to --sweep-out.""")
     output_group = parser.add_argument_group("Output")
 
     output_group.add_argument('--report-out', type=argparse.FileType('w'),
             default=sys.stdout, help="""Output file for report [default:
             stdout]""")
+    output_group.add_argument('--quality-bins', metavar='BINS',
+            type=quality_bins, help="""Replace the quality scores of passing
+            reads with binned values on output, to improve compression: either
+            "illumina" for Illumina 8-level binning, or a comma-separated list
+            of min:value pairs, e.g. 0:2,10:15,20:30. Filters use the original
+            scores. [default: no binning]""")
     output_group.add_argument('--failure-out', type=argparse.FileType('w'),
             help="""File to write failure report [default: None]""")
+    output_group.add_argument('--quality-profile-out',
+            type=argparse.FileType('w'), metavar='PROFILE', help="""File to
+            write per-position quality score counts for input and passing
+            reads, as tab-delimited stage, position, quality, count rows
+            [default: None]""")
+
+    paired_group = parser.add_argument_group('Paired reads')
+    paired_group.add_argument('--mate-input', type=argparse.FileType('r'),
+            metavar='MATE_FASTQ', help="""Fastq file containing the mates of
+            the reads in input_fastq, in the same order. A pair passes only if
+            both mates pass.""")
+    paired_group.add_argument('--mate-output', type=argparse.FileType('w'),
+            metavar='MATE_OUTPUT', help="""Output file for mates of passing
+            pairs. Required with --mate-input.""")
+    paired_group.add_argument('--singleton-out', type=argparse.FileType('w'),
+            help="""Output file for reads from input_fastq which passed when
+            their mate did not [default: None]""")
+    paired_group.add_argument('--mate-singleton-out',
+            type=argparse.FileType('w'), help="""Output file for reads from
+            --mate-input which passed when their mate did not [default:
+            None]""")
+
+    sweep_group = parser.add_argument_group('Parameter sweep')
+    sweep_group.add_argument('--sweep-params', type=argparse.FileType('r'),
+            metavar='CSV', help="""CSV file of filter parameter sets to
+            evaluate in a single pass over the input. The header names
+            options (e.g. min_mean_quality, quality_window, min_length); each
+            row is a parameter set, overriding the command line values where
+            not blank. An optional 'name' column labels each set. Report rows
+            are prefixed with the set name. Reads are filtered serially;
+            --threads and --reorder-filters are not used.""")
+    sweep_group.add_argument('--sweep-out', metavar='TEMPLATE',
+            help="""Write the reads passing each parameter set to
+            TEMPLATE, with {name} replaced by the set name [default: don't
+            write passing reads]""")
+
+    parser.add_argument('--threads', metavar='N', type=positive_value(int),
+            default=1, help="""Number of worker processes to filter reads
+            with. Output order matches input order. [default:
+            %(default)s]""")
 
+    parser.add_argument('--reorder-filters', action='store_true',
+            help="""Measure the time taken and rejection rate of each filter
+            over the first reads, and run filters which don't modify reads in
+            the order minimizing the expected time per read. Reads passing are
+            unchanged; the report lists filters in the order used.""")
+    parser.add_argument('--reorder-sample-size', metavar='N',
+            type=positive_value(int), default=DEFAULT_REORDER_SAMPLE_SIZE,
+            help="""Number of reads used to choose the filter order with
+            --reorder-filters [default: %(default)s]""")
     parser.add_argument('--min-mean-quality', metavar='QUALITY', type=float,
             default=DEFAULT_MEAN_SCORE, help="""Minimum mean quality score for
             each read [default: %(default)s]""")
@@ -73,7 +169,34 @@ def build_parser(parser):
             default=1000, help="""Maximum length to keep before truncating
             [default: %(default)s]. This operation occurs before
             --max-ambiguous""")
-
+    parser.add_argument('--max-expected-errors', metavar='ERRORS',
+            type=positive_value(float), help="""Maximum number of expected
+            errors (the sum of the error probabilities given by each quality
+            score) in each read. Applied after --max-length.
+            [default: no limit]""")
+    parser.add_argument('--truncate-expected-errors', metavar='ERRORS',
+            type=positive_value(float), help="""Truncate reads at the
+            position where the number of expected errors exceeds ERRORS,
+            removing reads where it is exceeded at the first base. Applied
+            after --quality-window. [default: no truncation]""")
+
+
+    adapter_group = parser.add_argument_group("3' adapter trimming")
+    adapter_group.add_argument('--adapter', metavar='SEQUENCE',
+            help="""Sequence of an adapter ligated to the 3' end of reads.
+            The adapter, or a prefix of it at the end of a read, is found
+            allowing mismatches and indels, and removed along with any
+            following bases. IUPAC ambiguity codes in the adapter are
+            supported. Applied after --quality-window and
+            --truncate-expected-errors.""")
+    adapter_group.add_argument('--adapter-error-rate', metavar='RATE',
+            type=typed_range(float, 0.0, 1.0),
+            default=DEFAULT_ADAPTER_ERROR_RATE, help="""Maximum number of
+            errors per aligned adapter base [default: %(default)s]""")
+    adapter_group.add_argument('--adapter-min-overlap', metavar='LENGTH',
+            type=positive_value(int), default=DEFAULT_ADAPTER_MIN_OVERLAP,
+            help="""Minimum number of adapter bases which must match at the
+            3' end of a read to trim it [default: %(default)s]""")
 
     window_group = parser.add_argument_group('Quality window options')
     window_group.add_argument('--quality-window-mean-qual', type=float,
@@ -100,6 +223,10 @@ def build_parser(parser):
             require""")
     barcode_group.add_argument('--barcode-file', help="""CSV file
             containing sample_id,barcode rows""", type=argparse.FileType('r'))
+    barcode_group.add_argument('--barcode-mismatches', type=int,
+            choices=(0, 1), default=0, help="""Number of substitutions to
+            allow in barcodes. Substitutions which would match more than one
+            barcode are not allowed. [default: %(default)s]""")
     barcode_group.add_argument('--barcode-header', action='store_true',
             default=False, help="""Barcodes have a header row [default:
             %(default)s]""")
@@ -110,6 +237,15 @@ def build_parser(parser):
             attribute of the csv module defining the quoting behavior for
             `SAMPLE_MAP`.  [default: %(default)s]""", default='QUOTE_MINIMAL',
             choices=[s for s in dir(csv) if s.startswith('QUOTE_')])
+    barcode_group.add_argument('--sample-out', metavar='TEMPLATE',
+            help="""Also write passing reads to one file per sample. TEMPLATE
+            is a path containing '{sample}', which is replaced by the sample
+            label (e.g. 'demux/{sample}.fastq'). Format is determined from
+            the extension. Requires --barcode-file.""")
+    barcode_group.add_argument('--max-open-files', metavar='N',
+            type=positive_value(int), default=DEFAULT_MAX_OPEN_FILES,
+            help="""Maximum number of per-sample output files to hold open at
+            once [default: %(default)s]""")
 
 def mean(sequence):
     """
@@ -118,6 +254,14 @@ def mean(sequence):
     return sum(sequence) / float(len(sequence))
 
 
+def _quality_array(quality_scores):
+    """
+    Convert a list of Phred quality scores to a numpy array of unsigned bytes.
+
+    Considerably faster than numpy.array for short lists of ints.
+    """
+    return numpy.frombuffer(bytearray(quality_scores), dtype=numpy.uint8)
+
 def moving_average(iterable, n):
     """
     From Python collections module documentation
@@ -133,30 +277,128 @@ def moving_average(iterable, n):
         d.append(elem)
         yield s / float(n)
 
-class FailureReportWriter(threading.Thread):
+class QualityProfile(object):
+    """
+    Histogram of quality scores at each position in a set of reads, stored as
+    a matrix of counts with one row per position and one column per Phred
+    score.
+
+    Scores are buffered by read length, and added to the matrix batch_size
+    scores at a time.
+    """
+    def __init__(self, length=DEFAULT_PROFILE_LENGTH,
+            batch_size=DEFAULT_PROFILE_BATCH_SIZE):
+        self.counts = numpy.zeros((length, PROFILE_SCORES),
+                dtype=numpy.uint64)
+        self.batch_size = batch_size
+        self._pending = {}
+        self._pending_size = 0
+
+    def add(self, quality_scores):
+        """
+        Add the quality scores from a single read
+        """
+        n = len(quality_scores)
+        try:
+            self._pending[n].extend(quality_scores)
+        except KeyError:
+            self._pending[n] = bytearray(quality_scores)
+        self._pending_size += n
+        if self._pending_size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Add any buffered scores to counts
+        """
+        max_length = max(self._pending) if self._pending else 0
+        if max_length > len(self.counts):
+            counts = numpy.zeros((max(max_length, 2 * len(self.counts)),
+                PROFILE_SCORES), dtype=numpy.uint64)
+            counts[:len(self.counts)] = self.counts
+            self.counts = counts
+
+        flat_counts = self.counts.ravel()
+        for length, scores in self._pending.iteritems():
+            if not length:
+                continue
+            # One row per read; offset each score to its (position, score)
+            # index in the flattened matrix
+            scores = numpy.frombuffer(scores, dtype=numpy.uint8)
+            index = (scores.reshape(-1, length) +
+                     numpy.arange(0, length * PROFILE_SCORES, PROFILE_SCORES))
+            totals = numpy.bincount(index.ravel())
+            flat_counts[:len(totals)] += totals.astype(numpy.uint64)
+        self._pending.clear()
+        self._pending_size = 0
+
+    def observe(self, records):
+        """
+        Add the quality scores of each record, yielding each record.
+        """
+        for record in records:
+            self.add(record.letter_annotations['phred_quality'])
+            yield record
+
+    def rows(self):
+        """
+        Generate (position, quality, count) tuples for each nonzero count.
+        Positions are 1-indexed.
+        """
+        self.flush()
+        positions, scores = numpy.nonzero(self.counts)
+        for position, score in itertools.izip(positions, scores):
+            yield (position + 1, score, self.counts[position, score])
+
+def write_quality_profiles(fp, profiles):
+    """
+    Write (stage, QualityProfile) pairs in a tab-delimited format.
+    """
+    writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
+    writer.writerow(('stage', 'position', 'quality', 'count'))
+    for stage, profile in profiles:
+        writer.writerows((stage,) + row for row in profile.rows())
+
+
+class FailureReportWriter(object):
     """
     Writes a log of sequences that failed filtering, and the filter that
     removed them.
+
+    Failures are passed to put() as (failed_sequence, reason, value) tuples,
+    buffered, and written in batches of batch_size. Any remaining failures
+    are written by close().
     """
-    def __init__(self, queue, fp):
-        super(FailureReportWriter, self).__init__()
-        self.queue = queue
-        self.writer = csv.DictWriter(fp, ('failed_sequence', 'reason', 'value'),
-                delimiter='\t', lineterminator='\n')
-        self.writer.writeheader()
+    fields = ('failed_sequence', 'reason', 'value')
 
-    def run(self):
-        while True:
-            try:
-                record = self.queue.get(timeout=1)
-            except Empty:
-                continue
+    def __init__(self, fp, batch_size=DEFAULT_FAILURE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.batch = []
+        self.writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
+        self.writer.writerow(self.fields)
+
+    def put(self, failure):
+        self.batch.append(failure)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def extend(self, failures):
+        self.batch.extend(failures)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.batch)
+        del self.batch[:]
+
+    def close(self):
+        self.flush()
 
-            if record is None:
-                self.queue.task_done()
-                return
-            self.writer.writerow(record)
-            self.queue.task_done()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class Failure(object):
@@ -177,6 +419,10 @@ class BaseFilter(object):
     report_fields = ['name', 'passed_unchanged', 'passed_changed', 'failed',
             'total_filtered', 'proportion_passed']
 
+    # True if the filter neither modifies records nor has side effects, so
+    # may be run in any order relative to other reorderable filters.
+    reorderable = False
+
     def __init__(self):
         self.passed_unchanged = 0
         self.passed_changed = 0
@@ -190,25 +436,50 @@ class BaseFilter(object):
         """
         raise NotImplementedError("Override in subclass")
 
+    def counts(self):
+        """
+        Returns a tuple of (passed_unchanged, passed_changed, failed)
+        """
+        return self.passed_unchanged, self.passed_changed, self.failed
+
+    def merge_counts(self, counts):
+        """
+        Add counts, as returned by counts(), from another instance of this
+        filter
+        """
+        passed_unchanged, passed_changed, failed = counts
+        self.passed_unchanged += passed_unchanged
+        self.passed_changed += passed_changed
+        self.failed += failed
+
+    def apply(self, record, failure_queue=None):
+        """
+        Apply the filter to a single record, updating counts.
+
+        Returns the result of filter_record.
+        """
+        filtered = self.filter_record(record)
+        if filtered:
+            # Quick tracking whether the sequence was modified
+            if filtered == record:
+                self.passed_unchanged += 1
+            else:
+                self.passed_changed += 1
+        else:
+            self.failed += 1
+            if failure_queue is not None:
+                value = filtered.value if filtered is not None else None
+                failure_queue.put((record.id, self.name, value))
+        return filtered
+
     def filter_records(self, records, failure_queue=None):
         """
         Apply the filter to records
         """
         for record in records:
-            filtered = self.filter_record(record)
+            filtered = self.apply(record, failure_queue)
             if filtered:
-                # Quick tracking whether the sequence was modified
-                if filtered == record:
-                    self.passed_unchanged += 1
-                else:
-                    self.passed_changed += 1
                 yield filtered
-            else:
-                self.failed += 1
-                if failure_queue:
-                    value = filtered.value if filtered is not None else None
-                    failure_queue.put({'failed_sequence': record.id,
-                        'reason': self.name, 'value': value})
 
     @property
     def passed(self):
@@ -233,6 +504,7 @@ class QualityScoreFilter(BaseFilter):
     Quality score filter - requires that the average base quality over the
     length of the read is greater than some threshold.
     """
+    reorderable = True
 
     def __init__(self, min_mean_score=DEFAULT_MEAN_SCORE):
         super(QualityScoreFilter, self).__init__()
@@ -277,21 +549,179 @@ class WindowQualityScoreFilter(BaseFilter):
             mean_score = mean(quality_scores)
             return record if mean_score >= self.min_mean_score else Failure(mean_score)
 
-        # Find the right clipping point. Start clipping at the beginning of the
-        # sequence, then extend the window to include regions with acceptable
-        # mean quality scores.
-        clip_right = 0
-        for i, a in enumerate(moving_average(quality_scores,
-            self.window_size)):
-
-            if a >= self.min_mean_score:
-                clip_right = i + self.window_size
-            else:
-                break
+        # Find the right clipping point: the end of the last window with an
+        # acceptable mean quality score before the first which falls below
+        # the threshold. Window sums are taken from the cumulative sum of
+        # quality scores.
+        n = self.window_size
+        cumulative = numpy.cumsum(_quality_array(quality_scores))
+        window_sums = cumulative[n - 1:].copy()
+        window_sums[1:] -= cumulative[:-n]
+        failing = window_sums / float(n) < self.min_mean_score
+
+        if not failing.any():
+            clip_right = len(quality_scores)
+        else:
+            first_failing = failing.argmax()
+            clip_right = first_failing + n - 1 if first_failing else 0
 
         if clip_right:
             return record[:clip_right]
 
+class MaxExpectedErrorFilter(BaseFilter):
+    """
+    Expected error filter - requires that the expected number of errors in
+    the read, the sum of 10^(-Q/10) over its quality scores, is at most some
+    threshold.
+    """
+    name = "Maximum Expected Errors"
+    reorderable = True
+
+    def __init__(self, max_errors):
+        super(MaxExpectedErrorFilter, self).__init__()
+        self.max_errors = max_errors
+        self.name = self.name + " [{0}]".format(max_errors)
+
+    def filter_record(self, record):
+        quality_scores = record.letter_annotations['phred_quality']
+        errors = _PHRED_ERROR_PROBABILITY[
+                _quality_array(quality_scores)].sum()
+        return record if errors <= self.max_errors else Failure(errors)
+
+class TruncateExpectedErrorFilter(BaseFilter):
+    """
+    Truncate records at the first position where the expected number of
+    errors exceeds some threshold. Records exceeding the threshold at the
+    first base fail.
+    """
+    name = "Truncate Expected Errors"
+
+    def __init__(self, max_errors):
+        super(TruncateExpectedErrorFilter, self).__init__()
+        self.max_errors = max_errors
+        self.name = self.name + " [{0}]".format(max_errors)
+
+    def filter_record(self, record):
+        quality_scores = record.letter_annotations['phred_quality']
+        errors = numpy.cumsum(_PHRED_ERROR_PROBABILITY[
+                _quality_array(quality_scores)])
+        # Number of leading bases within the threshold
+        keep = errors.searchsorted(self.max_errors, side='right')
+        if keep == len(record):
+            return record
+        elif keep:
+            return record[:keep]
+        else:
+            return Failure(errors[0])
+
+class AdapterTrimFilter(BaseFilter):
+    """
+    Trim a 3' adapter, and any sequence following it, from records.
+
+    The adapter may occur anywhere in the read, or only a prefix of it at the
+    3' end, with up to max_error_rate errors (mismatches or indels) per
+    aligned adapter base. At least min_overlap adapter bases must align.
+
+    Matches are found with Myers' bit-parallel approximate matching algorithm
+    over the reversed read and adapter, so the search reports where each
+    match starts in the read. Partial matches are found by prefixing the
+    reversed read with one wildcard per adapter base. Among acceptable
+    matches, the one with the largest overlap less errors is trimmed, with
+    ties going to the fewest errors, then the longest trim.
+
+    Records trimmed to zero length fail.
+    """
+    name = "3' Adapter"
+
+    def __init__(self, adapter, max_error_rate=DEFAULT_ADAPTER_ERROR_RATE,
+            min_overlap=DEFAULT_ADAPTER_MIN_OVERLAP):
+        super(AdapterTrimFilter, self).__init__()
+        if not adapter:
+            raise ValueError("An adapter sequence is required")
+        self.adapter = adapter.upper()
+        self.max_error_rate = max_error_rate
+        self.min_overlap = max(min_overlap, 1)
+        self.name = self.name + " [{0}; error_rate: {1}]".format(
+                self.adapter, max_error_rate)
+
+        # Bit i of peq[c] is set if position i of the reversed adapter
+        # matches c. Ambiguity codes match each of their bases, and N in the
+        # adapter matches any character.
+        m = len(self.adapter)
+        self._mask = (1 << m) - 1
+        self._high_bit = 1 << (m - 1)
+        self._wildcards = 0
+        peq = collections.defaultdict(int)
+        for i, c in enumerate(reversed(self.adapter)):
+            if c == 'N':
+                self._wildcards |= 1 << i
+            for base in _AMBIGUOUS_MAP.get(c, c).strip('[]'):
+                peq[base] |= 1 << i
+        self._peq = dict((c, v | self._wildcards) for c, v in peq.iteritems())
+        self._peq[None] = self._mask
+
+        # Maximum errors for each number of aligned adapter bases
+        self._max_errors = [int(max_error_rate * i) for i in xrange(m + 1)]
+
+        # State after matching the wildcard prefix is the same for every read
+        self._initial_state = self._search([None] * m, (self._mask, 0, m))[0]
+
+    def _search(self, text, state):
+        """
+        Run the search over text, starting from state (Pv, Mv, score). None in
+        text matches any adapter base.
+
+        Returns the final state, and a list of the edit distance of the best
+        alignment of the reversed adapter ending at each position of text.
+        """
+        pv, mv, score = state
+        mask, high_bit = self._mask, self._high_bit
+        peq, default = self._peq, self._wildcards
+        scores = []
+        for c in text:
+            eq = peq.get(c, default)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & high_bit:
+                score += 1
+            elif mh & high_bit:
+                score -= 1
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            scores.append(score)
+        return (pv, mv, score), scores
+
+    def adapter_start(self, sequence):
+        """
+        Returns the index at which the adapter starts in sequence, or None if
+        there is no acceptable match.
+        """
+        n, m = len(sequence), len(self.adapter)
+        _, scores = self._search(sequence[::-1].upper(), self._initial_state)
+        best, best_key = None, None
+        for end in xrange(self.min_overlap, n + 1):
+            errors = scores[end - 1]
+            overlap = min(end, m)
+            if errors > self._max_errors[overlap]:
+                continue
+            key = (overlap - errors, -errors, end)
+            if best_key is None or key > best_key:
+                best, best_key = end, key
+        return None if best is None else n - best
+
+    def filter_record(self, record):
+        start = self.adapter_start(str(record.seq))
+        if start is None:
+            return record
+        elif start:
+            return record[:start]
+        else:
+            return Failure(0)
+
 class AmbiguousBaseFilter(BaseFilter):
     """
     Filter records, taking some action if 'N' is encountered in the sequence.
@@ -306,6 +736,7 @@ class AmbiguousBaseFilter(BaseFilter):
         if action not in ('truncate', 'drop'):
             raise ValueError("Unknown action: {0}".format(action))
         self.action = action
+        self.reorderable = action == 'drop'
         self.name = AmbiguousBaseFilter.name + " [{0}]".format(action)
 
     def filter_record(self, record):
@@ -327,6 +758,7 @@ class MaxAmbiguousFilter(BaseFilter):
     Filters records exceeding some minimum number of ambiguous bases
     """
     name = "Maximum Ambiguous Bases"
+    reorderable = True
 
     def __init__(self, max_ambiguous):
         super(MaxAmbiguousFilter, self).__init__()
@@ -346,6 +778,8 @@ class MinLengthFilter(BaseFilter):
     """
     Remove records which don't meet minimum length
     """
+    reorderable = True
+
     def __init__(self, min_length):
         super(MinLengthFilter, self).__init__()
         assert min_length > 0
@@ -381,19 +815,35 @@ class MaxLengthFilter(BaseFilter):
         else:
             return record
 
+def _barcode_neighbors(barcode, alphabet='ACGTN'):
+    """
+    Generate all sequences differing from barcode by a single substitution
+    """
+    for i, c in enumerate(barcode):
+        for b in alphabet:
+            if b != c:
+                yield barcode[:i] + b + barcode[i + 1:]
+
 class PrimerBarcodeFilter(BaseFilter):
     """
     Filter that checks that the sequence starts with a known barcode/primer
     combination.
 
-    Sequences that pass the filter have the barcode and primer removed.
+    Barcodes must all be the same length, and are looked up by the prefix of
+    each sequence. If mismatches is 1, sequences with a single substitution in
+    the barcode are also assigned, provided the substitution does not make
+    the barcode ambiguous.
+
+    Sequences that pass the filter have the barcode and primer removed, and
+    the sample label stored in record.annotations['sample_id'].
 
     If an output_file is provided, (sequence_id, sample_id) tuples are written
     to it.
     """
     name = "Primer/Barcode"
 
-    def __init__(self, primer, barcodes, output_file=None, trim=True, quoting=csv.QUOTE_MINIMAL):
+    def __init__(self, primer, barcodes, output_file=None, trim=True,
+            quoting=csv.QUOTE_MINIMAL, mismatches=0):
         super(PrimerBarcodeFilter, self).__init__()
         self.primer = primer
         self.barcodes = barcodes
@@ -403,23 +853,243 @@ class PrimerBarcodeFilter(BaseFilter):
         else:
             self.writer = None
 
-        self.pattern = re.compile('^({0}){1}'.format('|'.join(barcodes),
-                                                    _ambiguous_pattern(primer)),
-                                  re.IGNORECASE)
+        if mismatches not in (0, 1):
+            raise ValueError("Unsupported number of barcode mismatches: "
+                    "{0}".format(mismatches))
+        barcode_lengths = set(len(barcode) for barcode in barcodes)
+        if len(barcode_lengths) > 1:
+            raise ValueError("Barcodes must all be the same length")
+        self.barcode_length = barcode_lengths.pop() if barcode_lengths else 0
+
+        # Map from barcode (or barcode with a single substitution) to sample
+        self.samples = dict((barcode.upper(), sample)
+                            for barcode, sample in barcodes.iteritems())
+        if mismatches:
+            self.name += " [mismatches: {0}]".format(mismatches)
+            neighbors = {}
+            for barcode, sample in self.samples.iteritems():
+                for neighbor in _barcode_neighbors(barcode):
+                    if neighbor in self.samples:
+                        continue
+                    # Neighbors of more than one barcode are ambiguous
+                    if neighbors.setdefault(neighbor, sample) != sample:
+                        neighbors[neighbor] = None
+            self.samples.update((k, v) for k, v in neighbors.iteritems()
+                                if v is not None)
+
+        self.primer_pattern = re.compile(_ambiguous_pattern(primer),
+                                         re.IGNORECASE)
 
     def _report_match(self, record, sample):
-        if not self.writer:
+        if self.writer is None:
             return
         self.writer.writerow((record.id, sample))
 
     def filter_record(self, record):
-        m = self.pattern.match(str(record.seq))
+        sequence = str(record.seq)
+        sample = self.samples.get(sequence[:self.barcode_length].upper())
+        if sample is None:
+            return None
+
+        m = self.primer_pattern.match(sequence, self.barcode_length)
         if m:
-            self._report_match(record, self.barcodes[m.group(1)])
+            self._report_match(record, sample)
             if self.trim:
                 record = record[m.end():]
+            record.annotations['sample_id'] = sample
             return record
 
+def _filter_groups(filters):
+    """
+    Split filters into lists of consecutive reorderable filters, and lists
+    containing a single filter which must keep its position.
+    """
+    for reorderable, group in itertools.groupby(filters,
+            operator.attrgetter('reorderable')):
+        if reorderable:
+            yield list(group)
+        else:
+            for f in group:
+                yield [f]
+
+def order_filters(filters, sample):
+    """
+    Choose an order for filters minimizing the expected time to filter a
+    read, based on the time taken and rejection rate of each filter over
+    the records in sample.
+
+    Only consecutive reorderable filters are exchanged: within each run,
+    filters are sorted by time per rejected read, so cheap, selective filters
+    run first. Filters which modify records or have side effects keep their
+    position, so the records passing are unchanged. Filter counts are not
+    updated.
+
+    Returns a new list of filters.
+    """
+    groups = list(_filter_groups(filters))
+    # Filters after the last run of reorderable filters needn't be measured
+    while groups and not groups[-1][0].reorderable:
+        groups.pop()
+
+    elapsed = collections.Counter()
+    rejected = collections.Counter()
+    for record in sample:
+        for group in groups:
+            if not group[0].reorderable:
+                record = group[0].filter_record(record)
+            else:
+                # Each filter sees every record reaching the group
+                passed = True
+                for f in group:
+                    start = timeit.default_timer()
+                    result = f.filter_record(record)
+                    elapsed[f] += timeit.default_timer() - start
+                    if not result:
+                        rejected[f] += 1
+                        passed = False
+                if not passed:
+                    record = None
+            if not record:
+                break
+
+    def cost(f):
+        if not rejected[f]:
+            return float('inf'), elapsed[f]
+        return elapsed[f] / rejected[f], 0
+
+    result = []
+    for group in _filter_groups(filters):
+        # sorted is stable, so ties keep their original order
+        result.extend(sorted(group, key=cost) if group[0].reorderable
+                      else group)
+    return result
+
+def _apply_filters(filters, record, failure_queue=None):
+    """
+    Apply a chain of filters to a single record, returning None if any filter
+    fails.
+    """
+    for f in filters:
+        record = f.apply(record, failure_queue)
+        if not record:
+            return None
+    return record
+
+def _mate_id(sequence_id):
+    """
+    Identifier shared by both mates of a pair: sequence_id without any /1 or
+    /2 suffix
+    """
+    if sequence_id.endswith(('/1', '/2')):
+        return sequence_id[:-2]
+    return sequence_id
+
+def iter_pairs(forward, reverse):
+    """
+    Generate (forward, reverse) tuples from two iterables of mates, checking
+    that IDs correspond.
+    """
+    for f, r in itertools.izip_longest(forward, reverse):
+        if f is None or r is None:
+            raise ValueError("Mate files contain different numbers of reads")
+        if _mate_id(f.id) != _mate_id(r.id):
+            raise ValueError("Mates out of sync: {0} and {1}".format(f.id,
+                r.id))
+        yield f, r
+
+class PairFilter(BaseFilter):
+    """
+    Filter read pairs, applying a chain of filters to each mate. A pair passes
+    if both mates pass.
+
+    filter_records yields (forward, reverse) tuples for pairs where at least
+    one mate passed, with None in place of a failed mate.
+    """
+    name = "Read Pairs"
+
+    def __init__(self, forward_filters, reverse_filters):
+        super(PairFilter, self).__init__()
+        self.forward_filters = forward_filters
+        self.reverse_filters = reverse_filters
+
+    @property
+    def mate_filters(self):
+        return self.forward_filters + self.reverse_filters
+
+    def filter_records(self, pairs, failure_queue=None):
+        forward_filters = self.forward_filters
+        reverse_filters = self.reverse_filters
+        for forward, reverse in pairs:
+            f = _apply_filters(forward_filters, forward, failure_queue)
+            r = _apply_filters(reverse_filters, reverse, failure_queue)
+            if f and r:
+                if f == forward and r == reverse:
+                    self.passed_unchanged += 1
+                else:
+                    self.passed_changed += 1
+            else:
+                self.failed += 1
+                if not (f or r):
+                    continue
+            yield f, r
+
+def _fasta_entries(handle):
+    """
+    Generate (title, lines) tuples for each entry in a FASTA-formatted file
+    """
+    title = None
+    lines = []
+    for line in handle:
+        if line.startswith('>'):
+            if title is not None:
+                yield title, lines
+            title = line[1:].rstrip()
+            lines = []
+        elif title is not None:
+            lines.append(line)
+    if title is not None:
+        yield title, lines
+
+def fasta_qual_records(fasta_handle, qual_handle):
+    """
+    Generate SeqRecords with phred_quality letter annotations from a FASTA
+    file and its corresponding QUAL file.
+
+    Produces the same records as QualityIO.PairedFastaQualIterator, but the
+    quality scores for each entry are parsed in a single call to numpy, and
+    IDs are checked before any records are built.
+    """
+    entries = itertools.izip_longest(_fasta_entries(fasta_handle),
+            _fasta_entries(qual_handle), fillvalue=(None, None))
+    for (title, sequence_lines), (qual_title, qual_lines) in entries:
+        if title is None:
+            raise ValueError("QUAL file has more entries than FASTA file")
+        if qual_title is None:
+            raise ValueError("FASTA file has more entries than QUAL file")
+        sequence_id = title.split(None, 1)[0] if title else ''
+        qual_id = qual_title.split(None, 1)[0] if qual_title else ''
+        if sequence_id != qual_id:
+            raise ValueError("FASTA and QUAL entries do not match "
+                    "({0} vs {1})".format(sequence_id, qual_id))
+
+        sequence = ''.join(sequence_lines).translate(None, ' \t\r\n')
+        text = ''.join(qual_lines).strip()
+        if text:
+            scores = numpy.fromstring(text, dtype=int, sep=' ')
+        else:
+            scores = numpy.zeros(0, dtype=int)
+        # fromstring stops silently at the first token it can't parse
+        if len(scores) != len(text.split()):
+            raise ValueError("Invalid quality scores for "
+                    "{0}".format(sequence_id))
+        if len(scores) != len(sequence):
+            raise ValueError("Sequence length and number of quality scores "
+                    "disagree for {0}".format(sequence_id))
+
+        yield SeqRecord(Seq(sequence), id=sequence_id, name=sequence_id,
+                description=title,
+                letter_annotations={'phred_quality': scores.tolist()})
+
 def parse_barcode_file(fp, header=False):
     """
     Load label, barcode pairs from a CSV file.
@@ -458,68 +1128,596 @@ def parse_barcode_file(fp, header=False):
 
     return d
 
-def action(arguments):
+def _ambiguous_action(string):
+    if string not in ('truncate', 'drop'):
+        raise argparse.ArgumentTypeError("Invalid ambiguous action: " +
+                string)
+    return string
+
+# Options which may be varied with --sweep-params, and their types, matching
+# those of the command line options
+_SWEEP_PARAMETERS = {
+        'adapter_error_rate': typed_range(float, 0.0, 1.0),
+        'adapter_min_overlap': positive_value(int),
+        'ambiguous_action': _ambiguous_action,
+        'max_ambiguous': int,
+        'max_expected_errors': positive_value(float),
+        'max_length': int,
+        'min_length': int,
+        'min_mean_quality': float,
+        'quality_window': int,
+        'quality_window_mean_qual': float,
+        'truncate_expected_errors': positive_value(float),
+}
+
+def validate_filter_options(arguments):
     """
-    Given parsed arguments, filter input files.
+    Check the filter options in arguments, raising ValueError for invalid
+    combinations.
     """
     if arguments.quality_window_mean_qual and not arguments.quality_window:
         raise ValueError("--quality-window-mean-qual specified without "
                 "--quality-window")
 
-    queue = None
-    if arguments.failure_out:
-        queue = Queue()
-        t = FailureReportWriter(queue, arguments.failure_out)
-        t.setDaemon(True)
-        t.start()
+def parse_sweep_file(fp, arguments=None):
+    """
+    Load parameter sets from a CSV file with a header row naming options.
+
+    Returns a list of (name, parameters) tuples, where parameters maps from
+    argument name to value. Blank values are omitted.
+
+    If arguments is given, each parameter set is checked with
+    validate_filter_options, in place of the values in arguments.
+    """
+    result = []
+    names = set()
+    reader = csv.DictReader(fp)
+    for i, row in enumerate(reader, 1):
+        # Values beyond the header columns are stored under None
+        if None in row:
+            raise ValueError("Line {0} of sweep file has more values than "
+                    "the header".format(reader.line_num))
+        name = row.pop('name', None) or 'set{0}'.format(i)
+        if name in names:
+            raise ValueError("Duplicate parameter set name: {0}".format(name))
+        names.add(name)
+
+        parameters = {}
+        for key, value in row.iteritems():
+            dest = key.strip().lstrip('-').replace('-', '_')
+            if dest not in _SWEEP_PARAMETERS:
+                raise ValueError("Unknown sweep parameter: {0}".format(key))
+            if value:
+                try:
+                    parameters[dest] = _SWEEP_PARAMETERS[dest](value.strip())
+                except (ValueError, argparse.ArgumentTypeError) as e:
+                    raise ValueError("Line {0} of sweep file: invalid {1}: "
+                            "{2}".format(reader.line_num, key, e))
+
+        if arguments is not None:
+            set_arguments = argparse.Namespace(**vars(arguments))
+            vars(set_arguments).update(parameters)
+            try:
+                validate_filter_options(set_arguments)
+            except ValueError as e:
+                raise ValueError("Line {0} of sweep file: {1}".format(
+                    reader.line_num, e))
+        result.append((name, parameters))
+    return result
+
+class BatchWriter(object):
+    """
+    Writes records to an open handle buffer_size records at a time, for
+    outputs written to one record at a time.
+    """
+    def __init__(self, handle, file_type,
+            buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+        if file_type not in _APPENDABLE_FORMATS:
+            raise ValueError("Cannot write records in batches in format "
+                    "{0}".format(file_type))
+        self.handle = handle
+        self.file_type = file_type
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        SeqIO.write(self.buffer, self.handle, self.file_type)
+        del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.handle.close()
+
+
+class SampleWriter(object):
+    """
+    Writes records to one file per sample, using the sample label stored in
+    record.annotations['sample_id'] by PrimerBarcodeFilter.
+
+    Records are buffered per sample and written buffer_size at a time. At
+    most max_open files are held open; when another is required, the least
+    recently used file is closed, and reopened for appending if needed again.
+    """
+    def __init__(self, path_template, file_type,
+            buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+            max_open=DEFAULT_MAX_OPEN_FILES):
+        if file_type not in _APPENDABLE_FORMATS:
+            raise ValueError("Cannot write per-sample files in format "
+                    "{0}".format(file_type))
+        self.path_template = path_template
+        self.file_type = file_type
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.buffers = collections.defaultdict(list)
+        self.handles = collections.OrderedDict()
+        self.created = set()
+
+    def path(self, sample):
+        return self.path_template.format(sample=sample)
+
+    def _handle(self, sample):
+        """
+        Get an open handle for sample, marking it as most recently used.
+        Handles are keyed by path, so samples sharing a path share a file.
+        """
+        path = self.path(sample)
+        try:
+            handle = self.handles.pop(path)
+        except KeyError:
+            if len(self.handles) >= self.max_open:
+                _, lru = self.handles.popitem(last=False)
+                lru.close()
+            mode = 'a' if path in self.created else 'w'
+            handle = open(path, mode)
+            self.created.add(path)
+        self.handles[path] = handle
+        return handle
+
+    def _flush(self, sample):
+        records = self.buffers.pop(sample)
+        SeqIO.write(records, self._handle(sample), self.file_type)
+
+    def write(self, record):
+        sample = record.annotations['sample_id']
+        buf = self.buffers[sample]
+        buf.append(record)
+        if len(buf) >= self.buffer_size:
+            self._flush(sample)
+
+    def write_records(self, records):
+        """
+        Write records to per-sample files, yielding each record.
+        """
+        for record in records:
+            self.write(record)
+            yield record
+
+    def close(self):
+        for sample in self.buffers.keys():
+            self._flush(sample)
+        for handle in self.handles.itervalues():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Collector(list):
+    """
+    List standing in for a failure queue or csv writer in a worker process.
+    Collected items are passed back to the parent process.
+    """
+    put = list.append
+    writerow = list.append
+
+
+def _all_filters(filters):
+    """
+    List filters, along with any filters applied to mates by a PairFilter.
+    """
+    result = []
+    for f in filters:
+        result.append(f)
+        result.extend(getattr(f, 'mate_filters', []))
+    return result
 
+# Filters used by a worker process, set by _init_worker
+_worker_filters = None
+
+def _init_worker(filters):
+    """
+    Initialize a worker process for filter_records_parallel.
+
+    Any filter writing to an output file has its writer replaced with a
+    _Collector; rows are written by the parent.
+    """
+    global _worker_filters
+    for f in _all_filters(filters):
+        if getattr(f, 'writer', None) is not None:
+            f.writer = _Collector()
+    _worker_filters = filters
+
+def _filter_chunk(records):
+    """
+    Pass a chunk of records through the complete filter chain in a worker
+    process.
+
+    Returns a tuple of (passed records, per-filter counts, failures,
+    per-filter rows written), with filters ordered as by _all_filters.
+    """
+    filters = _worker_filters
+    all_filters = _all_filters(filters)
+    before = [f.counts() for f in all_filters]
+    failures = _Collector()
+    for f in filters:
+        records = f.filter_records(records, failures)
+    records = list(records)
+
+    counts = [tuple(a - b for a, b in zip(f.counts(), c))
+              for f, c in zip(all_filters, before)]
+    rows = []
+    for f in all_filters:
+        writer = getattr(f, 'writer', None)
+        if writer is None:
+            rows.append(None)
+        else:
+            rows.append(list(writer))
+            del writer[:]
+    return records, counts, failures, rows
+
+def filter_records_parallel(records, filters, failure_queue=None,
+        processes=2, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Apply a chain of filters to records using a pool of worker processes.
+
+    Records are read in chunks of chunk_size, each chunk passing through all
+    filters in a single worker. Passing records are yielded in input order.
+    Filter counts, failures and rows written by filters are merged back into
+    the instances in this process.
+    """
+    all_filters = _all_filters(filters)
+    def merge(result):
+        passed, counts, failures, rows = result
+        for f, c, r in zip(all_filters, counts, rows):
+            f.merge_counts(c)
+            if r:
+                f.writer.writerows(r)
+        if failure_queue is not None:
+            failure_queue.extend(failures)
+        return passed
+
+    records = iter(records)
+    chunks = iter(lambda: list(itertools.islice(records, chunk_size)), [])
+    pool = multiprocessing.Pool(processes, _init_worker, (filters,))
+    try:
+        # Limit the number of chunks in flight, rather than letting the pool
+        # read the whole input into memory.
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_filter_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                for record in merge(pending.popleft().get()):
+                    yield record
+        while pending:
+            for record in merge(pending.popleft().get()):
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def build_filters(arguments, barcodes=None):
+    """
+    Build the chain of filters specified by arguments.
+
+    If barcodes (a map from barcode to sample) are provided, a
+    PrimerBarcodeFilter is added to the end of the chain.
+    """
     # Always filter with a quality score
     qfilter = QualityScoreFilter(arguments.min_mean_quality)
     filters = [qfilter]
 
+    if arguments.max_length:
+        max_length_filter = MaxLengthFilter(arguments.max_length)
+        filters.append(max_length_filter)
+    if arguments.max_expected_errors is not None:
+        max_ee_filter = MaxExpectedErrorFilter(arguments.max_expected_errors)
+        filters.append(max_ee_filter)
+    if arguments.min_length:
+        min_length_filter = MinLengthFilter(arguments.min_length)
+        filters.append(min_length_filter)
+    if arguments.max_ambiguous is not None:
+        max_ambig_filter = MaxAmbiguousFilter(arguments.max_ambiguous)
+        filters.append(max_ambig_filter)
+    if arguments.ambiguous_action:
+        ambiguous_filter = AmbiguousBaseFilter(
+                arguments.ambiguous_action)
+        filters.append(ambiguous_filter)
+    if arguments.adapter:
+        adapter_filter = AdapterTrimFilter(arguments.adapter,
+                arguments.adapter_error_rate, arguments.adapter_min_overlap)
+        filters.insert(0, adapter_filter)
+    if arguments.truncate_expected_errors is not None:
+        truncate_ee_filter = TruncateExpectedErrorFilter(
+                arguments.truncate_expected_errors)
+        filters.insert(0, truncate_ee_filter)
+    if arguments.quality_window:
+        min_qual = arguments.quality_window_mean_qual or \
+                arguments.min_mean_quality
+        window_filter = WindowQualityScoreFilter(arguments.quality_window,
+                min_qual)
+        filters.insert(0, window_filter)
+
+    if barcodes:
+        f = PrimerBarcodeFilter(arguments.primer or '', barcodes,
+                arguments.map_out,
+                quoting=getattr(csv, arguments.quoting),
+                mismatches=arguments.barcode_mismatches)
+        filters.append(f)
+
+    return filters
+
+def _filter_reads(arguments, sequences, barcodes, failures, profiles=None):
+    """
+    Filter single reads, writing to the output file(s).
+
+    If profiles is a list, (stage, QualityProfile) pairs are appended for the
+    input and passing reads.
+
+    Returns the filters applied.
+    """
+    filters = build_filters(arguments, barcodes)
+
+    if profiles is not None:
+        input_profile, passed_profile = QualityProfile(), QualityProfile()
+        profiles.extend([('input', input_profile),
+            ('passed', passed_profile)])
+        sequences = input_profile.observe(sequences)
+
+    if arguments.reorder_filters:
+        sample = list(itertools.islice(sequences,
+            arguments.reorder_sample_size))
+        filters = order_filters(filters, sample)
+        sequences = itertools.chain(sample, sequences)
+
+    if arguments.threads > 1:
+        sequences = filter_records_parallel(sequences, filters,
+                failures, arguments.threads)
+    else:
+        for f in filters:
+            sequences = f.filter_records(sequences, failures)
+
+    if profiles is not None:
+        sequences = passed_profile.observe(sequences)
+
+    if arguments.quality_bins:
+        sequences = transform.bin_quality_scores(sequences,
+                arguments.quality_bins)
+
+    sample_writer = None
+    if arguments.sample_out:
+        sample_writer = SampleWriter(arguments.sample_out,
+                fileformat.from_filename(arguments.sample_out),
+                max_open=arguments.max_open_files)
+        sequences = sample_writer.write_records(sequences)
+
     output_type = fileformat.from_filename(arguments.output_file.name)
+    with arguments.output_file:
+        SeqIO.write(sequences, arguments.output_file, output_type)
+
+    if sample_writer:
+        sample_writer.close()
+
+    return filters
+
+def _sweep_reads(arguments, sequences, barcodes, failures, profiles=None):
+    """
+    Filter reads with each parameter set from --sweep-params, reading the
+    input once. Passing reads are written only if --sweep-out is given.
+
+    If profiles is a list, an ('input', QualityProfile) pair is appended.
+
+    Returns the filters applied, in parameter set order.
+    """
+    with arguments.sweep_params as fp:
+        parameter_sets = parse_sweep_file(fp, arguments)
+
+    if profiles is not None:
+        input_profile = QualityProfile()
+        profiles.append(('input', input_profile))
+        sequences = input_profile.observe(sequences)
+
+    sets = []
+    for name, parameters in parameter_sets:
+        set_arguments = argparse.Namespace(**vars(arguments))
+        vars(set_arguments).update(parameters)
+        filters = build_filters(set_arguments, barcodes)
+        for f in filters:
+            f.name = '{0}: {1}'.format(name, f.name)
+        writer = None
+        if arguments.sweep_out:
+            path = arguments.sweep_out.format(name=name)
+            writer = BatchWriter(open(path, 'w'),
+                    fileformat.from_filename(path))
+        sets.append((filters, writer))
+
+    quality_table = None
+    if arguments.quality_bins:
+        quality_table = transform.quality_bin_table(arguments.quality_bins)
+
+    for record in sequences:
+        for filters, writer in sets:
+            filtered = _apply_filters(filters, record, failures)
+            if filtered and writer is not None:
+                if quality_table is not None:
+                    # Copy, since later parameter sets may see the same record
+                    filtered = transform.bin_record_quality(filtered[:],
+                            quality_table)
+                writer.write(filtered)
+
+    for _, writer in sets:
+        if writer is not None:
+            writer.close()
+
+    return [f for filters, _ in sets for f in filters]
+
+def _filter_pairs(arguments, sequences, barcodes, failures, profiles=None):
+    """
+    Filter read pairs from sequences and --mate-input, writing mates of
+    passing pairs and any singletons in the same pass.
+
+    If profiles is a list, (stage, QualityProfile) pairs are appended for the
+    input reads and mates of passing pairs.
+
+    Returns the filters applied.
+    """
+    forward_filters = build_filters(arguments, barcodes)
+    reverse_filters = build_filters(arguments)
+    for prefix, filters in (('R1', forward_filters), ('R2', reverse_filters)):
+        for f in filters:
+            f.name = '{0}: {1}'.format(prefix, f.name)
+    pair_filter = PairFilter(forward_filters, reverse_filters)
+
+    with arguments.mate_input as fp:
+        mates = SeqIO.parse(fp, 'fastq')
+        if profiles is not None:
+            input_profile, mate_input_profile = \
+                    QualityProfile(), QualityProfile()
+            passed_profile, mate_passed_profile = \
+                    QualityProfile(), QualityProfile()
+            profiles.extend([('input', input_profile),
+                ('mate_input', mate_input_profile),
+                ('passed', passed_profile),
+                ('mate_passed', mate_passed_profile)])
+            sequences = input_profile.observe(sequences)
+            mates = mate_input_profile.observe(mates)
+
+        pairs = iter_pairs(sequences, mates)
+        if arguments.reorder_filters:
+            sample = list(itertools.islice(pairs,
+                arguments.reorder_sample_size))
+            pair_filter.forward_filters = order_filters(forward_filters,
+                    [forward for forward, _ in sample])
+            pair_filter.reverse_filters = order_filters(reverse_filters,
+                    [reverse for _, reverse in sample])
+            pairs = itertools.chain(sample, pairs)
+        if arguments.threads > 1:
+            pairs = filter_records_parallel(pairs, [pair_filter], failures,
+                    arguments.threads)
+        else:
+            pairs = pair_filter.filter_records(pairs, failures)
+
+        def writer(handle):
+            if handle is None:
+                return None
+            return BatchWriter(handle, fileformat.from_filename(handle.name))
+        writers = [writer(handle) for handle in (arguments.output_file,
+            arguments.mate_output, arguments.singleton_out,
+            arguments.mate_singleton_out)]
+        forward_out, reverse_out, forward_singles, reverse_singles = writers
+
+        quality_table = None
+        if arguments.quality_bins:
+            quality_table = transform.quality_bin_table(arguments.quality_bins)
+
+        for forward, reverse in pairs:
+            if forward and reverse and profiles is not None:
+                passed_profile.add(
+                        forward.letter_annotations['phred_quality'])
+                mate_passed_profile.add(
+                        reverse.letter_annotations['phred_quality'])
+            if quality_table is not None:
+                forward = forward and transform.bin_record_quality(forward,
+                        quality_table)
+                reverse = reverse and transform.bin_record_quality(reverse,
+                        quality_table)
+            if forward and reverse:
+                forward_out.write(forward)
+                reverse_out.write(reverse)
+            elif forward and forward_singles:
+                forward_singles.write(forward)
+            elif reverse and reverse_singles:
+                reverse_singles.write(reverse)
+            elif failures is not None:
+                # A passing mate dropped because its partner failed
+                failures.put(((forward or reverse).id, pair_filter.name,
+                    None))
+
+        for w in writers:
+            if w is not None:
+                w.close()
+
+    return pair_filter.mate_filters + [pair_filter]
+
+def action(arguments):
+    """
+    Given parsed arguments, filter input files.
+    """
+    validate_filter_options(arguments)
+    if arguments.sample_out and not arguments.barcode_file:
+        raise ValueError("--sample-out specified without --barcode-file")
+    if arguments.sample_out and '{sample}' not in arguments.sample_out:
+        raise ValueError("--sample-out template must contain '{sample}'")
+    if arguments.mate_input:
+        if not arguments.mate_output:
+            raise ValueError("--mate-input specified without --mate-output")
+        if arguments.input_qual:
+            raise ValueError("--mate-input requires fastq input")
+        if arguments.sample_out:
+            raise ValueError("--sample-out is not supported with "
+                    "--mate-input")
+    elif (arguments.mate_output or arguments.singleton_out or
+            arguments.mate_singleton_out):
+        raise ValueError("Paired outputs specified without --mate-input")
+    if arguments.sweep_params:
+        if arguments.output_file is not sys.stdout:
+            raise ValueError("output_file is not used with --sweep-params; "
+                    "specify '-', and use --sweep-out to write passing reads")
+        if arguments.mate_input or arguments.sample_out or arguments.map_out:
+            raise ValueError("--sweep-params is not supported with "
+                    "--mate-input, --sample-out or --map-out")
+    elif arguments.sweep_out:
+        raise ValueError("--sweep-out specified without --sweep-params")
+
+    failures = None
+    if arguments.failure_out:
+        failures = FailureReportWriter(arguments.failure_out)
+
+    barcodes = None
+    if arguments.barcode_file:
+        with arguments.barcode_file:
+            barcodes = parse_barcode_file(arguments.barcode_file,
+                    arguments.barcode_header)
+
     with arguments.input_fastq as fp:
         if arguments.input_qual:
-            sequences = QualityIO.PairedFastaQualIterator(fp,
-                    arguments.input_qual)
+            sequences = fasta_qual_records(fp, arguments.input_qual)
         else:
             sequences = SeqIO.parse(fp, 'fastq')
 
-        # Add filters
-        if arguments.max_length:
-            max_length_filter = MaxLengthFilter(arguments.max_length)
-            filters.append(max_length_filter)
-        if arguments.min_length:
-            min_length_filter = MinLengthFilter(arguments.min_length)
-            filters.append(min_length_filter)
-        if arguments.max_ambiguous is not None:
-            max_ambig_filter = MaxAmbiguousFilter(arguments.max_ambiguous)
-            filters.append(max_ambig_filter)
-        if arguments.ambiguous_action:
-            ambiguous_filter = AmbiguousBaseFilter(
-                    arguments.ambiguous_action)
-            filters.append(ambiguous_filter)
-        if arguments.quality_window:
-            min_qual = arguments.quality_window_mean_qual or \
-                    arguments.min_mean_quality
-            window_filter = WindowQualityScoreFilter(arguments.quality_window,
-                    min_qual)
-            filters.insert(0, window_filter)
-
-        if arguments.barcode_file:
-            with arguments.barcode_file:
-                barcodes = parse_barcode_file(arguments.barcode_file,
-                        arguments.barcode_header)
-            f = PrimerBarcodeFilter(arguments.primer or '', barcodes,
-                    arguments.map_out,
-                    quoting=getattr(csv, arguments.quoting))
-            filters.append(f)
-
-        for f in filters:
-            sequences = f.filter_records(sequences, queue)
+        profiles = [] if arguments.quality_profile_out else None
+        if arguments.sweep_params:
+            filters = _sweep_reads(arguments, sequences, barcodes, failures,
+                    profiles)
+        elif arguments.mate_input:
+            filters = _filter_pairs(arguments, sequences, barcodes, failures,
+                    profiles)
+        else:
+            filters = _filter_reads(arguments, sequences, barcodes, failures,
+                    profiles)
 
-        with arguments.output_file:
-            SeqIO.write(sequences, arguments.output_file, output_type)
+    if profiles is not None:
+        with arguments.quality_profile_out as fp:
+            write_quality_profiles(fp, profiles)
 
     rpt_rows = (f.report_dict() for f in filters)
 
@@ -530,5 +1728,6 @@ def action(arguments):
         writer.writeheader()
         writer.writerows(rpt_rows)
 
-    if queue:
-        queue.join()
+    if failures:
+        with arguments.failure_out:
+            failures.close()
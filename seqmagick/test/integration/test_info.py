@@ -27,3 +27,114 @@ class TestInfo(unittest.TestCase):
 {0}\tTRUE\t4\t4\t4.00\t3
 """.format(seq_file), self.tempfile.read())
 
+
+    def test_jobs(self):
+        seq_files = [os.path.join(data_dir, f)
+                     for f in ('input1.fasta', 'input2.fasta', 'input3.fasta')]
+        expected = ''.join(self._info(seq_files))
+        for extra in (['-j', '2'], ['-j', '2', '--thread-pool']):
+            self.assertEquals(expected, ''.join(self._info(seq_files, extra)))
+        self.assertRaises(ValueError, self._info, seq_files,
+                          ['--thread-pool'])
+
+    def _info(self, seq_files, extra=[]):
+        with tempfile.NamedTemporaryFile() as tf:
+            cli.main(['info', '--out-file', tf.name] + seq_files + extra)
+            return tf.readlines()
+
+    def test_fastq(self):
+        self.infile.write('@r1\nACGT\n+\nIIII\n@r2\nAC\n+r2\nII\n')
+        self.infile.flush()
+        cli.main(['info', '--input-format', 'fastq', self.infile.name,
+                  '--out-file', self.tempfile.name])
+        self.assertEquals("""name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs
+{0}\tFALSE\t2\t4\t3.00\t2
+""".format(self.infile.name), self.tempfile.read())
+
+    def test_fastq_multiline(self):
+        self.infile.write('@r1\nACGT\nAC\n+\nIIII\nII\n@r2\nAC\n+\nII\n')
+        self.infile.flush()
+        cli.main(['info', '--input-format', 'fastq', self.infile.name,
+                  '--out-file', self.tempfile.name])
+        self.assertEquals("""name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs
+{0}\tFALSE\t2\t6\t4.00\t2
+""".format(self.infile.name), self.tempfile.read())
+
+    def test_fasta_multiline(self):
+        self.infile.write('>s1 desc\nAC GT\r\nAC\n>s2\n>s3\nACGTAC\n')
+        self.infile.flush()
+        cli.main(['info', '--input-format', 'fasta', self.infile.name,
+                  '--out-file', self.tempfile.name])
+        self.assertEquals("""name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs
+{0}\tFALSE\t0\t6\t4.00\t3
+""".format(self.infile.name), self.tempfile.read())
+
+    def test_stats(self):
+        self.infile.write('>s1\nACGGN-\n>s2\nAT\n>s3\nGGCC\n')
+        self.infile.flush()
+        with tempfile.NamedTemporaryFile() as histogram:
+            cli.main(['info', '--input-format', 'fasta', self.infile.name,
+                      '--out-file', self.tempfile.name, '--stats',
+                      '--length-histogram', histogram.name,
+                      '--histogram-bin-width', '3'])
+            self.assertEquals("""name\tmin_len\tmax_len\tcount
+{0}\t0\t2\t1
+{0}\t3\t5\t1
+{0}\t6\t8\t1
+""".format(self.infile.name), histogram.read())
+        self.assertEquals("""name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs\ttotal_len\tn50\tn90\tgc\tambiguous\tgaps
+{0}\tFALSE\t2\t6\t4.00\t3\t12\t6\t2\t0.7000\t0.0909\t0.0833
+""".format(self.infile.name), self.tempfile.read())
+
+    def test_cache(self):
+        with tempfile.NamedTemporaryFile(suffix='.db') as cache:
+            self.infile.write('>s1\nACGT\n')
+            self.infile.flush()
+            args = ['--input-format', 'fasta', self.infile.name,
+                    '--cache', cache.name]
+            expected = """name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs
+{0}\tTRUE\t4\t4\t4.00\t1
+""".format(self.infile.name)
+            self.assertEquals(expected, ''.join(self._info(args)))
+            # Served from the cache
+            self.assertEquals(expected, ''.join(self._info(args)))
+            # File changed
+            self.infile.write('>s2\nAC\n')
+            self.infile.flush()
+            self.assertEquals("""name\talignment\tmin_len\tmax_len\tavg_len\tnum_seqs
+{0}\tFALSE\t2\t4\t3.00\t2
+""".format(self.infile.name), ''.join(self._info(args)))
+
+    def test_sample(self):
+        for i in xrange(400):
+            length = 20 + i % 7
+            self.infile.write('@r{0}\n{1}\n+\n{2}\n'.format(i, 'A' * length,
+                                                           'I' * length))
+        self.infile.flush()
+        args = ['--input-format', 'fastq', '--format', 'csv', '--sample']
+        header, row = self._info([self.infile.name], args)
+        self.assertEquals('name,alignment,min_len,max_len,avg_len,num_seqs,'
+                'num_seqs_low,num_seqs_high,avg_len_low,avg_len_high\n',
+                header)
+        self.assertEquals([self.infile.name, 'FALSE', '20', '26', '22.99',
+                           '400', '400', '400', '22.99', '22.99'],
+                          row.rstrip().split(','))
+
+        header, row = self._info([self.infile.name], args +
+                ['--sample-blocks', '8', '--sample-block-size', '500'])
+        row = row.rstrip().split(',')
+        self.assertEquals(['20', '26'], row[2:4])
+        low, count, high = int(row[6]), int(row[5]), int(row[7])
+        self.assertTrue(low <= count <= high)
+        self.assertTrue(low <= 400 <= high)
+
+    def test_per_record(self):
+        self.infile.write('>s1 desc\nAC-GN\nnn\n>s2\n>s3\nGG.C\n')
+        self.infile.flush()
+        lines = self._info([self.infile.name],
+                ['--input-format', 'fasta', '--per-record', '--format', 'csv'])
+        self.assertEquals([
+            'name,id,length,ungapped_length,gc,n_count,gap_count\n',
+            '{0},s1,7,6,0.6667,3,1\n'.format(self.infile.name),
+            '{0},s2,0,0,0.0000,0,0\n'.format(self.infile.name),
+            '{0},s3,4,3,1.0000,0,1\n'.format(self.infile.name)], lines)
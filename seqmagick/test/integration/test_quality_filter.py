@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Bio import SeqIO
+
+from seqmagick.scripts import cli
+
+FASTQ = """@seq1
+ACGTACGTACGT
++
+IIIIIIIIIIII
+@seq2
+ACGT
++
+IIII
+"""
+
+FASTA = """>seq1
+ACGTACGTACGT
+>seq2
+ACGT
+"""
+
+QUAL = """>seq1
+40 40 40 40 40 40 40 40 40 40 40 40
+>seq2
+40 40 40 40
+"""
+
+class TestQualityFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for name, content in (('in.fastq', FASTQ), ('in.fasta', FASTA),
+                              ('in.qual', QUAL)):
+            with open(self.path(name), 'w') as fp:
+                fp.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def path(self, name):
+        return os.path.join(self.tempdir, name)
+
+    def output_ids(self):
+        with open(self.path('out.fastq')) as fp:
+            return [r.id for r in SeqIO.parse(fp, 'fastq')]
+
+    def test_option_between_positionals(self):
+        cli.main(['quality-filter', self.path('in.fastq'), '--min-length',
+                  '10', self.path('out.fastq'),
+                  '--report-out', self.path('report.txt')])
+        self.assertEqual(['seq1'], self.output_ids())
+
+    def test_input_qual(self):
+        cli.main(['quality-filter', self.path('in.fasta'), '--input-qual',
+                  self.path('in.qual'), self.path('out.fastq'),
+                  '--min-length', '1',
+                  '--report-out', self.path('report.txt')])
+        self.assertEqual(['seq1', 'seq2'], self.output_ids())
+
+    def test_sweep_params(self):
+        with open(self.path('sweep.csv'), 'w') as fp:
+            fp.write('name,min_length\nshort,1\nlong,10\n')
+        cli.main(['quality-filter', self.path('in.fastq'), '-',
+                  '--sweep-params', self.path('sweep.csv'),
+                  '--sweep-out', self.path('{name}.fastq'),
+                  '--report-out', self.path('report.txt')])
+        with open(self.path('long.fastq')) as fp:
+            self.assertEqual(['seq1'],
+                             [r.id for r in SeqIO.parse(fp, 'fastq')])
+
+    def test_sweep_params_output_file(self):
+        with open(self.path('sweep.csv'), 'w') as fp:
+            fp.write('min_length\n1\n')
+        self.assertRaises(ValueError, cli.main, ['quality-filter',
+                          self.path('in.fastq'), self.path('out.fastq'),
+                          '--sweep-params', self.path('sweep.csv'),
+                          '--report-out', self.path('report.txt')])
+
+    def test_sample_out_without_sample(self):
+        with open(self.path('barcodes.csv'), 'w') as fp:
+            fp.write('S1,ACGT\n')
+        self.assertRaises(ValueError, cli.main, ['quality-filter',
+                          self.path('in.fastq'), self.path('out.fastq'),
+                          '--barcode-file', self.path('barcodes.csv'),
+                          '--sample-out', self.path('all.fastq'),
+                          '--report-out', self.path('report.txt')])
+
+    def test_dropped_mate_failure(self):
+        with open(self.path('mates.fastq'), 'w') as fp:
+            fp.write(FASTQ.replace('ACGTACGTACGT', 'ACGT')
+                          .replace('IIIIIIIIIIII', 'IIII'))
+        cli.main(['quality-filter', self.path('in.fastq'),
+                  self.path('out.fastq'), '--min-length', '10',
+                  '--mate-input', self.path('mates.fastq'),
+                  '--mate-output', self.path('mates_out.fastq'),
+                  '--failure-out', self.path('failures.txt'),
+                  '--report-out', self.path('report.txt')])
+        with open(self.path('failures.txt')) as fp:
+            rows = [line.split('\t')[:2] for line in fp][1:]
+        # seq1 passes, but its mate fails; both mates of seq2 fail
+        self.assertEqual(['seq1', 'seq1', 'seq2', 'seq2'],
+                         [i for i, _ in rows])
+        self.assertEqual(['seq1', 'Read Pairs'], rows[1])
@@ -56,6 +56,15 @@ class PositiveValueTestCase(unittest.TestCase):
     def test_zero(self):
         self.assertEqual(0, common.positive_value(int)('0'))
 
+class FalsePositiveRateTestCase(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(0.01, common.false_positive_rate('0.01'))
+
+    def test_invalid(self):
+        for value in ('0', '1', '5', '-0.1', 'x'):
+            self.assertRaises((argparse.ArgumentTypeError, ValueError),
+                    common.false_positive_rate, value)
+
 class CutRangeTestCase(unittest.TestCase):
     def test_negative(self):
         self.assertRaises(argparse.ArgumentTypeError,
@@ -79,6 +88,20 @@ class CutRangeTestCase(unittest.TestCase):
         actual = common.cut_range('5:')
         self.assertEqual(4, actual.start)
 
+class QualityBinsTestCase(unittest.TestCase):
+    def test_illumina(self):
+        actual = common.quality_bins('illumina')
+        self.assertEqual(7, len(actual))
+
+    def test_custom(self):
+        actual = common.quality_bins('0:2,10:15,20:30')
+        self.assertEqual([(0, 2), (10, 15), (20, 30)], actual)
+
+    def test_invalid(self):
+        for s in ('0:2,10', 'a:b', '0:2,0:3', '0:100'):
+            self.assertRaises(argparse.ArgumentTypeError,
+                    common.quality_bins, s)
+
 class SequenceSlicesTestCase(unittest.TestCase):
     def test_single(self):
         actual = common.sequence_slices(':10')
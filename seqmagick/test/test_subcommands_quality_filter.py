@@ -1,4 +1,9 @@
 from cStringIO import StringIO
+import argparse
+import os.path
+import random
+import shutil
+import tempfile
 import unittest
 
 from Bio.Seq import Seq
@@ -46,6 +51,34 @@ class WindowQualityFilterTestCase(unittest.TestCase):
         self.assertEqual(2, len(result))
         self.assertEqual('AC', str(result.seq))
 
+    def test_window_truncate_end(self):
+        self.sequence.letter_annotations['phred_quality'] = [25, 25, 25, 24]
+        result = self.instance.filter_record(self.sequence)
+        self.assertEqual('ACG', str(result.seq))
+
+    def test_matches_moving_average(self):
+        """
+        Clipping point should match that found with moving_average
+        """
+        rng = random.Random(1)
+        instance = quality_filter.WindowQualityScoreFilter(10, 25)
+        for i in xrange(200):
+            scores = [rng.randint(15, 40) for j in xrange(rng.randint(5, 80))]
+            sequence = SeqRecord(Seq('A' * len(scores)))
+            sequence.letter_annotations['phred_quality'] = scores
+
+            expected = 0
+            for j, a in enumerate(quality_filter.moving_average(scores, 10)):
+                if a < 25:
+                    break
+                expected = j + 10
+            if len(scores) <= 10:
+                expected = (len(scores)
+                        if quality_filter.mean(scores) >= 25 else 0)
+
+            result = instance.filter_record(sequence)
+            self.assertEqual(expected, len(result) if result else 0)
+
 class AmbiguousBaseFilterTestCase(unittest.TestCase):
     """
     Tests for ambiguous_base_filter
@@ -152,6 +185,118 @@ class MaxLengthFilterTestCase(unittest.TestCase):
         self.assertEqual(['ACG', 'ACT'], [str(s.seq) for s in actual])
         self.assertEqual([i.id for i in self.sequences], [i.id for i in actual])
 
+class MaxExpectedErrorFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        # Expected errors: 0.1 + 0.01 + 0.001 + 0.1 = 0.211
+        self.sequence = SeqRecord(Seq('ACGT'),
+                letter_annotations={'phred_quality': [10, 20, 30, 10]})
+
+    def test_pass(self):
+        instance = quality_filter.MaxExpectedErrorFilter(0.25)
+        actual = list(instance.filter_records([self.sequence]))
+        self.assertEqual([self.sequence], actual)
+
+    def test_fail(self):
+        instance = quality_filter.MaxExpectedErrorFilter(0.2)
+        actual = list(instance.filter_records([self.sequence]))
+        self.assertEqual([], actual)
+        self.assertEqual(1, instance.failed)
+
+class TruncateExpectedErrorFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequence = SeqRecord(Seq('ACGT'),
+                letter_annotations={'phred_quality': [10, 20, 30, 10]})
+
+    def test_pass(self):
+        instance = quality_filter.TruncateExpectedErrorFilter(0.25)
+        actual = list(instance.filter_records([self.sequence]))
+        self.assertEqual([self.sequence], actual)
+
+    def test_truncate(self):
+        instance = quality_filter.TruncateExpectedErrorFilter(0.2)
+        actual = list(instance.filter_records([self.sequence]))
+        self.assertEqual(1, len(actual))
+        self.assertEqual('ACG', str(actual[0].seq))
+
+    def test_fail(self):
+        instance = quality_filter.TruncateExpectedErrorFilter(0.05)
+        actual = list(instance.filter_records([self.sequence]))
+        self.assertEqual([], actual)
+
+class OrderFiltersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [SeqRecord(Seq('ACGT' * i),
+            letter_annotations={'phred_quality': [30] * 4 * i})
+            for i in range(1, 5)]
+
+    def test_selective_first(self):
+        quality = quality_filter.QualityScoreFilter(20)
+        length = quality_filter.MinLengthFilter(10)
+        actual = quality_filter.order_filters([quality, length],
+                self.sequences)
+        self.assertEqual([length, quality], actual)
+        # Counts are not updated
+        self.assertEqual(0, length.total_filtered)
+
+    def test_barrier(self):
+        quality = quality_filter.QualityScoreFilter(20)
+        max_length = quality_filter.MaxLengthFilter(12)
+        length = quality_filter.MinLengthFilter(10)
+        max_ambiguous = quality_filter.MaxAmbiguousFilter(0)
+        filters = [quality, max_length, max_ambiguous, length]
+        actual = quality_filter.order_filters(filters, self.sequences)
+        self.assertEqual([quality, max_length, length, max_ambiguous],
+                actual)
+
+    def test_empty_sample(self):
+        filters = [quality_filter.QualityScoreFilter(20),
+                   quality_filter.MinLengthFilter(10)]
+        self.assertEqual(filters, quality_filter.order_filters(filters, []))
+
+class AdapterTrimFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instance = quality_filter.AdapterTrimFilter('AGATCGGAAGAGC')
+
+    def _start(self, sequence):
+        return self.instance.adapter_start(sequence)
+
+    def test_full(self):
+        self.assertEqual(12, self._start('ACGTACGTACGTAGATCGGAAGAGCTTTT'))
+
+    def test_partial(self):
+        self.assertEqual(12, self._start('ACGTACGTACGTAGATCGG'))
+        self.assertEqual(8, self._start('ACGTACGTAGA'))
+
+    def test_min_overlap(self):
+        self.assertEqual(None, self._start('ACGTACGTAG'))
+
+    def test_errors(self):
+        # Mismatch
+        self.assertEqual(12, self._start('ACGTACGTACGTAGATCGGAAGTGC'))
+        # Deletion
+        self.assertEqual(12, self._start('ACGTACGTACGTAGATCGAAGAGCAAA'))
+        # Too many errors
+        self.assertEqual(None, self._start('ACGTACGTACGTAGTTCGCAAGTGC'))
+
+    def test_no_match(self):
+        self.assertEqual(None, self._start('ACGTACGTACGTTTTTTTTT'))
+
+    def test_wildcard(self):
+        instance = quality_filter.AdapterTrimFilter('AGNNCGG')
+        self.assertEqual(4, instance.adapter_start('ACGTAGTACGGTT'))
+
+    def test_filter(self):
+        sequences = [SeqRecord(Seq('ACGTACGTAGATCGGAAG'), id='s1',
+                               letter_annotations={'phred_quality': [40] * 18}),
+                     SeqRecord(Seq('AGATCGGAAGAGC'), id='s2',
+                               letter_annotations={'phred_quality': [40] * 13}),
+                     SeqRecord(Seq('ACGTACGTACGT'), id='s3',
+                               letter_annotations={'phred_quality': [40] * 12})]
+        actual = list(self.instance.filter_records(sequences))
+        self.assertEqual(['ACGTACGT', 'ACGTACGTACGT'],
+                         [str(s.seq) for s in actual])
+        self.assertEqual((1, 1, 1), self.instance.counts())
+
 class PrimerBarcodeFilterTestCase(unittest.TestCase):
     def setUp(self):
         self.sequences = [SeqRecord(Seq('ACCGTTACGAT'), 'seq1'),
@@ -174,6 +319,89 @@ class PrimerBarcodeFilterTestCase(unittest.TestCase):
         list(self.instance.filter_records(self.sequences))
         self.assertEqual("""seq1,Sample1
 seq2,Sample2
+""", self.outfile.getvalue())
+
+    def test_mismatch(self):
+        sequences = [SeqRecord(Seq('AGCGTTACGAT'), 'seq1'),  # 1 mismatch
+                     SeqRecord(Seq('acgGTTACGCT'), 'seq2'),  # ambiguous
+                     SeqRecord(Seq('TTTGTTACGCT'), 'seq3'),  # 3 mismatches
+                     ]
+        self.assertEqual([], list(self.instance.filter_records(sequences)))
+
+        instance = quality_filter.PrimerBarcodeFilter(self.primer,
+                self.barcodes, mismatches=1)
+        actual = list(instance.filter_records(sequences))
+        self.assertEqual(['seq1'], [s.id for s in actual])
+        self.assertEqual('CGAT', str(actual[0].seq))
+        self.assertEqual('Sample1', actual[0].annotations['sample_id'])
+
+    def test_barcode_length(self):
+        self.assertRaises(ValueError, quality_filter.PrimerBarcodeFilter,
+                self.primer, {'ACC': 'Sample1', 'AC': 'Sample2'})
+
+    def test_sample_annotation(self):
+        actual = list(self.instance.filter_records(self.sequences))
+        self.assertEqual(['Sample1', 'Sample2'],
+                [s.annotations['sample_id'] for s in actual])
+
+class SampleWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.template = os.path.join(self.tempdir, '{sample}.fasta')
+        self.sequences = []
+        for i, sample in enumerate(['S1', 'S2', 'S1', 'S3', 'S1']):
+            record = SeqRecord(Seq('ACGT'), 'seq{0}'.format(i),
+                    description='')
+            record.annotations['sample_id'] = sample
+            self.sequences.append(record)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write(self):
+        with quality_filter.SampleWriter(self.template, 'fasta',
+                buffer_size=1, max_open=2) as writer:
+            actual = list(writer.write_records(self.sequences))
+            self.assertEqual(2, len(writer.handles))
+        self.assertEqual(self.sequences, actual)
+
+        def ids(sample):
+            with open(self.template.format(sample=sample)) as fp:
+                return [l[1:].strip() for l in fp if l.startswith('>')]
+        self.assertEqual(['seq0', 'seq2', 'seq4'], ids('S1'))
+        self.assertEqual(['seq1'], ids('S2'))
+        self.assertEqual(['seq3'], ids('S3'))
+
+    def test_shared_path(self):
+        template = os.path.join(self.tempdir, 'all.fasta')
+        with quality_filter.SampleWriter(template, 'fasta',
+                buffer_size=1, max_open=2) as writer:
+            list(writer.write_records(self.sequences))
+        with open(template) as fp:
+            self.assertEqual(5, sum(l.startswith('>') for l in fp))
+
+    def test_invalid_format(self):
+        self.assertRaises(ValueError, quality_filter.SampleWriter,
+                self.template, 'phylip')
+
+class FailureReportWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.outfile = StringIO()
+        self.instance = quality_filter.FailureReportWriter(self.outfile,
+                batch_size=2)
+
+    def test_batches(self):
+        self.instance.put(('seq1', 'Minimum Length [4]', 3))
+        self.assertEqual('failed_sequence\treason\tvalue\n',
+                self.outfile.getvalue())
+        self.instance.put(('seq2', 'Ambiguous Base [drop]', None))
+        self.instance.extend([('seq3', 'Minimum Length [4]', 2)])
+        self.assertEqual(3, self.outfile.getvalue().count('\n'))
+        self.instance.close()
+        self.assertEqual("""failed_sequence\treason\tvalue
+seq1\tMinimum Length [4]\t3
+seq2\tAmbiguous Base [drop]\t
+seq3\tMinimum Length [4]\t2
 """, self.outfile.getvalue())
 
 class FailureTestCase(object):
@@ -184,3 +412,202 @@ class FailureTestCase(object):
         self.assertEqual(100, f.value)
         self.assertFalse(f)
 
+
+class FilterRecordsParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [SeqRecord(Seq('ACCGTTACGAT'), 'seq1'),
+                          SeqRecord(Seq('ACTGTTACGCT'), 'seq2'),
+                          SeqRecord(Seq('AACTGTTA'), 'seq3'),
+                          SeqRecord(Seq('ACCGTA'), 'seq4'),
+                          SeqRecord(Seq('ACTGTTAAAAA'), 'seq5'),
+                          ]
+        self.outfile = StringIO()
+        self.filters = [quality_filter.MinLengthFilter(7),
+                quality_filter.PrimerBarcodeFilter('GTTA',
+                    {'ACC': 'Sample1', 'ACT': 'Sample2'}, self.outfile)]
+
+    def test_matches_serial(self):
+        failures = []
+        actual = list(quality_filter.filter_records_parallel(
+            iter(self.sequences), self.filters, failures, processes=2,
+            chunk_size=2))
+        self.assertEqual(['seq1', 'seq2', 'seq5'], [s.id for s in actual])
+        self.assertEqual(['CGAT', 'CGCT', 'AAAA'],
+                [str(s.seq) for s in actual])
+        self.assertEqual([(4, 0, 1), (0, 3, 1)],
+                [f.counts() for f in self.filters])
+        self.assertEqual(['seq3', 'seq4'],
+                [f[0] for f in failures])
+        self.assertEqual("seq1,Sample1\nseq2,Sample2\nseq5,Sample2\n",
+                self.outfile.getvalue())
+
+    def test_list(self):
+        actual = list(quality_filter.filter_records_parallel(
+            self.sequences, self.filters, None, processes=2, chunk_size=2))
+        self.assertEqual(['seq1', 'seq2', 'seq5'], [s.id for s in actual])
+
+class PairFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.forward = [SeqRecord(Seq('ACGTACGT'), 'seq1/1'),
+                        SeqRecord(Seq('ACG'), 'seq2/1'),
+                        SeqRecord(Seq('ACGTAC'), 'seq3/1'),
+                        SeqRecord(Seq('AC'), 'seq4/1')]
+        self.reverse = [SeqRecord(Seq('TTTTTTTT'), 'seq1/2'),
+                        SeqRecord(Seq('TTTTT'), 'seq2/2'),
+                        SeqRecord(Seq('TTT'), 'seq3/2'),
+                        SeqRecord(Seq('T'), 'seq4/2')]
+
+    def build(self):
+        return quality_filter.PairFilter(
+                [quality_filter.MinLengthFilter(4),
+                    quality_filter.MaxLengthFilter(6)],
+                [quality_filter.MinLengthFilter(4)])
+
+    def check(self, instance, actual):
+        self.assertEqual([('seq1/1', 'seq1/2'), (None, 'seq2/2'),
+            ('seq3/1', None)],
+            [tuple(r.id if r else None for r in pair) for pair in actual])
+        self.assertEqual('ACGTAC', str(actual[0][0].seq))
+        self.assertEqual((0, 1, 3), instance.counts())
+        self.assertEqual([(2, 0, 2), (0, 2, 0), (2, 0, 2)],
+                [f.counts() for f in instance.mate_filters])
+
+    def test_filter(self):
+        instance = self.build()
+        pairs = quality_filter.iter_pairs(self.forward, self.reverse)
+        self.check(instance, list(instance.filter_records(pairs)))
+
+    def test_filter_parallel(self):
+        instance = self.build()
+        pairs = quality_filter.iter_pairs(self.forward, self.reverse)
+        actual = list(quality_filter.filter_records_parallel(pairs,
+            [instance], processes=2, chunk_size=1))
+        self.check(instance, actual)
+
+    def test_out_of_sync(self):
+        pairs = quality_filter.iter_pairs(self.forward, self.reverse[1:])
+        self.assertRaises(ValueError, list, pairs)
+
+class QualityProfileTestCase(unittest.TestCase):
+    def test_add(self):
+        instance = quality_filter.QualityProfile(length=2)
+        instance.add([30, 30, 20])
+        instance.add([30, 100])
+        instance.add([])
+        instance.flush()
+        self.assertEqual((4, quality_filter.PROFILE_SCORES),
+                instance.counts.shape)
+        self.assertEqual([(1, 30, 2), (2, 30, 1), (2, 100, 1), (3, 20, 1)],
+            list(instance.rows()))
+
+    def test_batches(self):
+        instance = quality_filter.QualityProfile(batch_size=3)
+        instance.add([30, 30])
+        self.assertEqual(0, instance.counts.sum())
+        instance.add([30])
+        self.assertEqual(3, instance.counts.sum())
+        self.assertEqual([(1, 30, 2), (2, 30, 1)], list(instance.rows()))
+
+    def test_write(self):
+        instance = quality_filter.QualityProfile()
+        instance.add([40, 2])
+        fp = StringIO()
+        quality_filter.write_quality_profiles(fp, [('input', instance)])
+        self.assertEqual("""stage\tposition\tquality\tcount
+input\t1\t40\t1
+input\t2\t2\t1
+""", fp.getvalue())
+
+class FastaQualRecordsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fasta = StringIO(""">seq1 first sequence
+ACGT
+AC
+>seq2
+GG
+""")
+        self.qual = StringIO(""">seq1 first sequence
+40 40 30
+20 10  2
+>seq2
+35 36
+""")
+
+    def test_parse(self):
+        actual = list(quality_filter.fasta_qual_records(self.fasta,
+            self.qual))
+        self.assertEqual(['seq1', 'seq2'], [r.id for r in actual])
+        self.assertEqual('seq1 first sequence', actual[0].description)
+        self.assertEqual(['ACGTAC', 'GG'], [str(r.seq) for r in actual])
+        self.assertEqual([[40, 40, 30, 20, 10, 2], [35, 36]],
+                [r.letter_annotations['phred_quality'] for r in actual])
+
+    def test_empty_record(self):
+        fasta = StringIO(self.fasta.getvalue() + '>seq3\n\n')
+        qual = StringIO(self.qual.getvalue() + '>seq3\n\n')
+        actual = list(quality_filter.fasta_qual_records(fasta, qual))
+        self.assertEqual('', str(actual[2].seq))
+        self.assertEqual([], actual[2].letter_annotations['phred_quality'])
+
+    def test_invalid_score(self):
+        # Scores parsed before the malformed token match the sequence length
+        self.fasta = StringIO(self.fasta.getvalue().replace('ACGT\nAC',
+                                                            'ACGT'))
+        self.qual = StringIO(self.qual.getvalue().replace('20 10', '20 x'))
+        records = quality_filter.fasta_qual_records(self.fasta, self.qual)
+        self.assertRaises(ValueError, list, records)
+
+    def test_id_mismatch(self):
+        self.qual = StringIO(self.qual.getvalue().replace('seq2', 'seq3'))
+        records = quality_filter.fasta_qual_records(self.fasta, self.qual)
+        self.assertRaises(ValueError, list, records)
+
+    def test_length_mismatch(self):
+        self.qual = StringIO(self.qual.getvalue().replace('35 36', '35'))
+        records = quality_filter.fasta_qual_records(self.fasta, self.qual)
+        self.assertRaises(ValueError, list, records)
+
+    def test_missing_entry(self):
+        self.qual = StringIO(self.qual.getvalue().split('>seq2')[0])
+        records = quality_filter.fasta_qual_records(self.fasta, self.qual)
+        self.assertRaises(ValueError, list, records)
+
+class ParseSweepFileTestCase(unittest.TestCase):
+    def test_parse(self):
+        fp = StringIO('name,min_mean_quality,quality-window\n'
+                               'q20,20,\n'
+                               ',25,10\n')
+        actual = quality_filter.parse_sweep_file(fp)
+        self.assertEqual([('q20', {'min_mean_quality': 20.0}),
+                          ('set2', {'min_mean_quality': 25.0,
+                                    'quality_window': 10})], actual)
+
+    def test_unknown_parameter(self):
+        fp = StringIO('min_mean_quality,primer\n20,ACGT\n')
+        self.assertRaises(ValueError, quality_filter.parse_sweep_file, fp)
+
+    def test_duplicate_name(self):
+        fp = StringIO('name,min_length\na,10\na,20\n')
+        self.assertRaises(ValueError, quality_filter.parse_sweep_file, fp)
+
+    def test_extra_values(self):
+        fp = StringIO('name,min_length\na,10\nb,20,30\n')
+        with self.assertRaises(ValueError) as cm:
+            quality_filter.parse_sweep_file(fp)
+        self.assertIn('Line 3', str(cm.exception))
+
+    def test_invalid_value(self):
+        fp = StringIO('ambiguous_action\ntruncate\nkeep\n')
+        with self.assertRaises(ValueError) as cm:
+            quality_filter.parse_sweep_file(fp)
+        self.assertIn('Line 3', str(cm.exception))
+
+    def test_validate(self):
+        arguments = argparse.Namespace(quality_window=0,
+                quality_window_mean_qual=None)
+        fp = StringIO('quality_window,quality_window_mean_qual\n10,20\n'
+                      ',20\n')
+        with self.assertRaises(ValueError) as cm:
+            quality_filter.parse_sweep_file(fp, arguments)
+        self.assertIn('Line 3', str(cm.exception))
+
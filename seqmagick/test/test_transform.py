@@ -5,6 +5,7 @@ Tests for seqmagick.transform
 from cStringIO import StringIO
 import functools
 import logging
+import tempfile
 import unittest
 
 from Bio import Alphabet, SeqIO
@@ -274,6 +275,12 @@ class IncludeFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
         self.assertEqual(3, len(actual))
         self.assertEqual(expected, actual)
 
+    def test_filter_fpr(self):
+        expected = [self.sequences[0], self.sequences[1], self.sequences[3]]
+        actual = list(transform.include_from_file(self.sequences, self.handle,
+                                                  fpr=0.5))
+        self.assertEqual(expected, actual)
+
 class ExcludeFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
 
     def test_filter(self):
@@ -282,6 +289,103 @@ class ExcludeFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
         self.assertEqual(2, len(actual))
         self.assertEqual(expected, actual)
 
+    def test_filter_fpr(self):
+        expected = [self.sequences[2], self.sequences[4]]
+        actual = list(transform.exclude_from_file(self.sequences, self.handle,
+                                                  fpr=0.5))
+        self.assertEqual(expected, actual)
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        keys = [str(i) for i in range(1000)]
+        bloom = transform.BloomFilter(len(keys), 0.01)
+        bloom.add_many(keys)
+        self.assertTrue(bloom.contains_many(keys).all())
+        self.assertTrue('0' in bloom)
+
+    def test_false_positive_rate(self):
+        bloom = transform.BloomFilter(1000, 0.01)
+        bloom.add_many([str(i) for i in range(1000)])
+        found = bloom.contains_many([str(i) for i in range(1000, 11000)])
+        self.assertTrue(found.mean() < 0.03)
+
+    def test_invalid_fpr(self):
+        self.assertRaises(ValueError, transform.BloomFilter, 10, 1.0)
+        self.assertRaises(ValueError, transform.DiskIdSet, 0.0)
+
+class DiskIdSetTestCase(unittest.TestCase):
+
+    def test_membership(self):
+        orig_run_size = transform.ID_SORT_RUN_SIZE
+        orig_width = transform.ID_MERGE_WIDTH
+        transform.ID_SORT_RUN_SIZE = 3
+        transform.ID_MERGE_WIDTH = 2
+        ids = transform.DiskIdSet(0.5)
+        try:
+            keys = [str(i) for i in range(20)]
+            for i in range(0, 20, 2):
+                ids.add_many(keys[i:i + 2])
+                self.assertEqual([True] * (i + 2) + [False] * (18 - i),
+                                 ids.contains_many(keys).tolist())
+        finally:
+            ids.close()
+            transform.ID_SORT_RUN_SIZE = orig_run_size
+            transform.ID_MERGE_WIDTH = orig_width
+
+class SortedIdFileTestCase(unittest.TestCase):
+
+    def test_sorted_ids(self):
+        ids = ['c', 'a', '', 'bb', 'a', 'b', 'c']
+        orig_run_size = transform.ID_SORT_RUN_SIZE
+        orig_interval = transform.ID_INDEX_INTERVAL
+        orig_width = transform.ID_MERGE_WIDTH
+        transform.ID_SORT_RUN_SIZE = 2
+        transform.ID_INDEX_INTERVAL = 2
+        transform.ID_MERGE_WIDTH = 2
+        try:
+            sorted_ids = transform.SortedIdFile(ids)
+        finally:
+            transform.ID_SORT_RUN_SIZE = orig_run_size
+            transform.ID_INDEX_INTERVAL = orig_interval
+            transform.ID_MERGE_WIDTH = orig_width
+        try:
+            self.assertEqual(['', 'a', 'b', 'bb', 'c'], list(sorted_ids))
+            self.assertEqual(5, len(sorted_ids))
+            for i in ids:
+                self.assertTrue(i in sorted_ids)
+            for i in ('0', 'aa', 'ba', 'bbb', 'd'):
+                self.assertFalse(i in sorted_ids)
+            self.assertEqual([True, False, True, False, True, False],
+                    sorted_ids.contains_many(['c', 'd', '', 'aa', 'bb',
+                                              'ba']).tolist())
+        finally:
+            sorted_ids.close()
+
+class DeduplicateTaxaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('1|a', 'A'), seqrecord('s1', 'C'),
+                          seqrecord('1|b', 'G'), seqrecord('s2', 'T'),
+                          seqrecord('x|a', 'A'), seqrecord('s1', 'A'),
+                          seqrecord('1', 'A'), seqrecord('x|a', 'C')]
+        self.expected = ['1|a', 's1', 's2', 'x|a', '1']
+
+    def test_deduplicate(self):
+        actual = transform.deduplicate_taxa(iter(self.sequences))
+        self.assertEqual(self.expected, [r.id for r in actual])
+
+    def test_deduplicate_fpr(self):
+        orig_batch_size = transform.ID_FILTER_BATCH_SIZE
+        transform.ID_FILTER_BATCH_SIZE = 3
+        try:
+            for fpr in (0.01, 0.5):
+                actual = transform.deduplicate_taxa(iter(self.sequences),
+                                                    fpr=fpr)
+                self.assertEqual(self.expected, [r.id for r in actual])
+        finally:
+            transform.ID_FILTER_BATCH_SIZE = orig_batch_size
+
 class CutTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -449,6 +553,171 @@ class MultiMaskSequences(unittest.TestCase):
         self.assertEqual(['A-A', 'B-B', 'D-DD', 'E-E'],
                 [str(a.seq) for a in actual])
 
+class BinQualityScoresTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [SeqRecord(Seq("ACGTA"), id="s1",
+            letter_annotations={'phred_quality': [0, 5, 12, 25, 41]}),
+            SeqRecord(Seq("AC"), id="s2")]
+
+    def test_illumina(self):
+        actual = list(transform.bin_quality_scores(self.sequences,
+            transform.ILLUMINA_QUALITY_BINS))
+        self.assertEqual([0, 6, 15, 27, 40],
+                actual[0].letter_annotations['phred_quality'])
+        self.assertEqual({}, actual[1].letter_annotations)
+
+    def test_custom(self):
+        actual = list(transform.bin_quality_scores(self.sequences,
+            [(20, 30), (0, 2), (10, 15)]))
+        self.assertEqual([2, 2, 15, 30, 30],
+                actual[0].letter_annotations['phred_quality'])
+
+class SequenceDigestTestCase(unittest.TestCase):
+    def test_case(self):
+        self.assertEqual(transform.sequence_digest('ACGT'),
+                         transform.sequence_digest(Seq('acgt')))
+        self.assertEqual(transform.DIGEST_SIZE,
+                         len(transform.sequence_digest('ACGT')))
+
+    def test_canonical(self):
+        self.assertNotEqual(transform.sequence_digest('AACGTG'),
+                            transform.sequence_digest('CACGTT'))
+        for s in ('AACGTG', 'cacgtt'):
+            self.assertEqual(transform.sequence_digest('AACGTG'),
+                             transform.sequence_digest(s, canonical=True))
+        self.assertEqual(transform.sequence_digest('NC-GTT', True),
+                         transform.sequence_digest('AAC-GN', True))
+        self.assertEqual(transform.sequence_digest('ACRY', True),
+                         transform.sequence_digest('RYGT', True))
+        self.assertEqual(transform.sequence_digest('AAAUCG', True),
+                         transform.sequence_digest('CGAUUU', True))
+        self.assertNotEqual(transform.sequence_digest('AAAUCG', True),
+                            transform.sequence_digest('CGAUUA', True))
+
+class DigestSetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.digests = [transform.sequence_digest(s)
+                        for s in ('ACGT', 'AC', 'GG', 'ACGT', 'acgt', '')]
+
+    def test_add_many(self):
+        digest_set = transform.DigestSet(capacity=2)
+        self.assertEqual([True, True, True, False, False, True],
+                list(digest_set.add_many(self.digests)))
+        self.assertEqual(4, len(digest_set))
+        self.assertEqual([False] * 6,
+                list(digest_set.add_many(self.digests)))
+        for digest in self.digests:
+            self.assertTrue(digest in digest_set)
+        self.assertFalse(transform.sequence_digest('T') in digest_set)
+
+    def test_add(self):
+        digest_set = transform.DigestSet()
+        self.assertTrue(digest_set.add(self.digests[0]))
+        self.assertFalse(digest_set.add(self.digests[0]))
+        self.assertTrue(digest_set.add('\0' * transform.DIGEST_SIZE))
+        self.assertEqual(2, len(digest_set))
+
+    def test_digest_size(self):
+        self.assertRaises(ValueError, transform.DigestSet().add, 'ACGT')
+
+class DigestIndexTestCase(unittest.TestCase):
+    def test_index_many(self):
+        digests = [transform.sequence_digest(s)
+                   for s in ('ACGT', 'AC', 'GG', 'ACGT', 'T', 'AC')]
+        digest_index = transform.DigestIndex(capacity=2)
+        self.assertEqual([0, 1, 2, 0, 3, 1],
+                list(digest_index.index_many(digests)))
+        self.assertEqual([3, 4, 0], list(digest_index.index_many(
+            [digests[4], transform.sequence_digest('A'), digests[0]])))
+        self.assertEqual(5, len(digest_index))
+
+class DereplicateSequencesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [seqrecord('s1', 'ACGT'), seqrecord('s2', 'AC'),
+                          seqrecord('s3', 'acgt'), seqrecord('s4', 'AC'),
+                          seqrecord('s5', 'GG'), seqrecord('s6', 'AC')]
+        self.sequences[0].description = 's1 first'
+
+    def test_dereplicate(self):
+        actual = list(transform.dereplicate_sequences(iter(self.sequences)))
+        self.assertEqual(['s1;size=2', 's2;size=3', 's5;size=1'],
+                         [r.id for r in actual])
+        self.assertEqual('s1;size=2 first', actual[0].description)
+        self.assertEqual(['ACGT', 'AC', 'GG'], [str(r.seq) for r in actual])
+
+    def test_list(self):
+        actual = transform.dereplicate_sequences(self.sequences)
+        self.assertEqual(['s1;size=2', 's2;size=3', 's5;size=1'],
+                         [r.id for r in actual])
+
+    def test_sort_by_size(self):
+        orig_batch_size = transform.DEDUPLICATE_BATCH_SIZE
+        transform.DEDUPLICATE_BATCH_SIZE = 2
+        try:
+            actual = transform.dereplicate_sequences(iter(self.sequences),
+                                                     sort_by_size=True)
+            self.assertEqual(['s2;size=3', 's1;size=2', 's5;size=1'],
+                             [r.id for r in actual])
+        finally:
+            transform.DEDUPLICATE_BATCH_SIZE = orig_batch_size
+
+class DeduplicateSequencesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [seqrecord('s1', 'ACGT'), seqrecord('s2', 'AC'),
+                          seqrecord('s3', 'acgt'), seqrecord('s4', 'AC'),
+                          seqrecord('s5', 'GG')]
+
+    def test_no_file(self):
+        actual = transform.deduplicate_sequences(iter(self.sequences), None)
+        self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+
+    def test_list(self):
+        actual = transform.deduplicate_sequences(self.sequences, None)
+        self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+
+    def test_batches(self):
+        orig_batch_size = transform.DEDUPLICATE_BATCH_SIZE
+        transform.DEDUPLICATE_BATCH_SIZE = 2
+        try:
+            self.test_no_file()
+            self.test_list()
+        finally:
+            transform.DEDUPLICATE_BATCH_SIZE = orig_batch_size
+
+    def test_canonical(self):
+        self.sequences.append(seqrecord('s6', 'CC'))
+        actual = transform.deduplicate_sequences(iter(self.sequences), None,
+                                                 canonical=True)
+        self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+
+    def test_partitioned(self):
+        for partitions in (1, 3):
+            actual = transform.deduplicate_sequences_partitioned(
+                    iter(self.sequences), partitions)
+            self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+
+    def test_file(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            actual = transform.deduplicate_sequences(iter(self.sequences),
+                                                     open(tf.name, 'w'))
+            self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+            self.assertEqual('s1 s3\ns2 s4\ns5\n', tf.read())
+
+    def test_pairs_file(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            actual = transform.deduplicate_sequences(iter(self.sequences),
+                                                     None, open(tf.name, 'w'))
+            self.assertEqual(['s1', 's2', 's5'], [r.id for r in actual])
+            self.assertEqual('s1\ts1\ns2\ts2\ns1\ts3\ns2\ts4\ns5\ts5\n',
+                             tf.read())
+
+    def test_group_cluster_pairs(self):
+        pairs = StringIO('0\t0\ts1\n1\t1\ts2\n0\t2\ts3\n3\t3\ts4\n'
+                         '1\t4\ts5\n0\t5\ts6\n')
+        for run_size in (None, 2):
+            self.assertEqual([['s1', 's3', 's6'], ['s2', 's5'], ['s4']],
+                    list(transform._group_cluster_pairs(pairs, run_size)))
+
 class RecordBufferTestCase(unittest.TestCase):
     def setUp(self):
         self.sequences = [SeqRecord(Seq("AAA"), id="s1"),
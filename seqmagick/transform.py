@@ -1,21 +1,33 @@
 """
 Functions to transform / filter sequences
 """
+import bisect
 import collections
 import contextlib
 import cPickle as pickle
+import functools
+import hashlib
+import heapq
 import itertools
 import logging
+import math
+import operator
 import re
 import string
+import struct
 import tempfile
 
+try:
+    from xxhash import xxh128 as _sequence_hash
+except ImportError:
+    from hashlib import md5 as _sequence_hash
+
 from Bio import SeqIO
 from Bio.Alphabet import generic_dna, generic_rna
 from Bio.Data import CodonTable
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
-from Bio.SeqUtils.CheckSum import seguid
+import numpy
 
 # Characters to be treated as gaps
 GAP_CHARS = "-."
@@ -23,6 +35,72 @@ GAP_CHARS = "-."
 # Size of temporary file buffer: default to 20MB
 DEFAULT_BUFFER_SIZE = 20971520 # 20*2**20
 
+# Length of each pickled record in a record buffer
+_RECORD_LENGTH = struct.Struct('<Q')
+
+# Size in bytes of the sequence digests kept when deduplicating sequences.
+# DigestSet uses 95 bits of each; the chance of two of 10^9 distinct
+# sequences sharing those is below 10^-10.
+DIGEST_SIZE = 12
+
+# Complements of upper case IUPAC nucleotide codes, for canonical sequence
+# digests. Other characters, such as gaps, are unchanged.
+_COMPLEMENT_TABLE = string.maketrans('ACGTRYKMBVDH', 'TGCAYRMKVBHD')
+# Canonical digests read RNA as DNA
+_RNA_TO_DNA_TABLE = string.maketrans('U', 'T')
+
+# Number of records whose digests are added to a DigestSet at once when
+# deduplicating sequences
+DEDUPLICATE_BATCH_SIZE = 1000
+
+# Number of (representative, member) pairs sorted in memory at once when
+# grouping deduplicated sequences into clusters
+CLUSTER_SORT_RUN_SIZE = 1 << 20
+
+# Number of IDs sorted in memory at once when sorting IDs on disk, and held
+# in memory by a DiskIdSet
+ID_SORT_RUN_SIZE = 1 << 16
+
+# Number of sorted runs of IDs, or files of a DiskIdSet, of the same level
+# merged at once
+ID_MERGE_WIDTH = 8
+
+# Number of IDs tested against Bloom filters at once
+ID_FILTER_BATCH_SIZE = 1000
+
+# Every ID_INDEX_INTERVAL-th ID in a SortedIdFile is held in memory
+ID_INDEX_INTERVAL = 128
+
+# Entries written to partition files when deduplicating sequences on disk: a
+# sequence digest, and the position of the record in the input
+_PARTITION_ENTRY = numpy.dtype([('digest', 'S{0}'.format(DIGEST_SIZE)),
+                                ('index', '<i8')])
+
+# Illumina 8-level quality binning, as (minimum score, binned score) pairs.
+# Scores below the first minimum (0 and 1) are unchanged.
+ILLUMINA_QUALITY_BINS = ((2, 6), (10, 15), (20, 22), (25, 27), (30, 33),
+                         (35, 37), (40, 40))
+
+def _write_buffered_record(handle, record):
+    """
+    Write a pickled record to handle, preceded by its length
+    """
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    handle.write(_RECORD_LENGTH.pack(len(data)))
+    handle.write(data)
+
+
+def _read_buffered_record(handle):
+    """
+    Read a record written by _write_buffered_record, or None at the end of
+    handle
+    """
+    length = handle.read(_RECORD_LENGTH.size)
+    if not length:
+        return None
+    return pickle.loads(handle.read(_RECORD_LENGTH.unpack(length)[0]))
+
+
 @contextlib.contextmanager
 def _record_buffer(records, buffer_size=DEFAULT_BUFFER_SIZE):
     """
@@ -31,19 +109,16 @@ def _record_buffer(records, buffer_size=DEFAULT_BUFFER_SIZE):
     Value returned by context manager is a function which returns an iterator
     through records.
     """
+    # Records are pickled separately, each preceded by its length: a shared
+    # Pickler would keep a reference to every record, and unpickling from the
+    # spooled file directly reads it a few bytes at a time.
     with tempfile.SpooledTemporaryFile(buffer_size, mode='wb+') as tf:
-        pickler = pickle.Pickler(tf)
         for record in records:
-            pickler.dump(record)
+            _write_buffered_record(tf, record)
 
         def record_iter():
             tf.seek(0)
-            unpickler = pickle.Unpickler(tf)
-            while True:
-                try:
-                    yield unpickler.load()
-                except EOFError:
-                    break
+            return iter(functools.partial(_read_buffered_record, tf), None)
 
         yield record_iter
 
@@ -61,47 +136,796 @@ def dashes_cleanup(records):
         yield record
 
 
-def deduplicate_sequences(records, out_file):
+def sequence_digest(sequence, canonical=False):
     """
-    Remove any duplicate records with identical sequences, keep the first
-    instance seen and discard additional occurences.
+    Digest of a sequence, ignoring case, of DIGEST_SIZE bytes.
+
+    If canonical is true, the digest is of the lesser of the sequence and its
+    reverse complement, so is the same for either strand. U is read as T, so
+    that RNA reverse complements match.
+    """
+    sequence = str(sequence).upper()
+    if canonical:
+        sequence = sequence.translate(_RNA_TO_DNA_TABLE)
+        sequence = min(sequence,
+                       sequence.translate(_COMPLEMENT_TABLE)[::-1])
+    return _sequence_hash(sequence).digest()[:DIGEST_SIZE]
+
+
+class DigestSet(object):
+    """
+    Set of DIGEST_SIZE-byte digests, stored in an open-addressing hash table
+    of numpy arrays, using 12 bytes per slot rather than a Python object per
+    digest.
+
+    Digests are added in batches with add_many, so that probing is
+    vectorized. capacity, the initial number of slots, must be a power of
+    two.
+    """
+
+    # Grow when more than this fraction of slots are full
+    max_load = 2.0 / 3
+
+    # A digest, as high and low words. The low bit of the low word is set on
+    # every stored digest, so zero marks an empty slot.
+    _dtype = numpy.dtype([('high', '<u8'), ('low', '<u4')])
+
+    def __init__(self, capacity=1 << 16):
+        self._count = 0
+        self._high = numpy.zeros(capacity, dtype=numpy.uint64)
+        self._low = numpy.zeros(capacity, dtype=numpy.uint32)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, digest):
+        high, low = self._words(digest)
+        high, low = int(high[0]), int(low[0])
+        mask = len(self._high) - 1
+        slot = high & mask
+        while self._low[slot]:
+            if self._high[slot] == high and self._low[slot] == low:
+                return True
+            slot = (slot + 1) & mask
+        return False
+
+    def _words(self, data):
+        """
+        High and low word arrays of the digests concatenated in data
+        """
+        if len(data) % DIGEST_SIZE:
+            raise ValueError("Expected digests of {0} bytes".format(
+                DIGEST_SIZE))
+        words = numpy.frombuffer(data, dtype=self._dtype)
+        return words['high'], words['low'] | 1
+
+    def _insert(self, high, low):
+        """
+        Insert digests, as arrays of words, which are distinct from each
+        other. Returns a boolean array, true for digests which were not
+        already present, and an array of the slot holding each digest.
+        """
+        added = numpy.zeros(len(high), dtype=bool)
+        digest_slots = numpy.empty(len(high), dtype=numpy.intp)
+        mask = numpy.uint64(len(self._high) - 1)
+        pending = numpy.arange(len(high))
+        slots = (high & mask).astype(numpy.intp)
+        while len(pending):
+            table_low = self._low[slots]
+            found = ((table_low == low[pending]) &
+                     (self._high[slots] == high[pending]))
+            digest_slots[pending[found]] = slots[found]
+            # Of several digests probing the same empty slot, the first
+            # takes it; the others move on at the next step
+            empty = numpy.flatnonzero(table_low == 0)
+            claimed = numpy.zeros(len(pending), dtype=bool)
+            if len(empty):
+                winners = empty[numpy.unique(slots[empty],
+                                             return_index=True)[1]]
+                self._high[slots[winners]] = high[pending[winners]]
+                self._low[slots[winners]] = low[pending[winners]]
+                added[pending[winners]] = True
+                digest_slots[pending[winners]] = slots[winners]
+                claimed[winners] = True
+
+            advance = table_low != 0
+            slots[advance] = (slots[advance] + 1) & int(mask)
+            remaining = ~(found | claimed)
+            pending = pending[remaining]
+            slots = slots[remaining]
+        self._count += int(added.sum())
+        return added, digest_slots
+
+    def _grow(self, capacity):
+        """
+        Move the digests to a table of capacity slots, returning arrays of
+        their old and new slots
+        """
+        occupied = numpy.flatnonzero(self._low)
+        high, low = self._high[occupied], self._low[occupied]
+        self._high = numpy.zeros(capacity, dtype=numpy.uint64)
+        self._low = numpy.zeros(capacity, dtype=numpy.uint32)
+        self._count = 0
+        return occupied, self._insert(high, low)[1]
+
+    def _batch(self, digests):
+        """
+        Words of a sequence of digests, with the position in digests of the
+        first occurrence of each distinct digest, in order, and the index in
+        those first occurrences of each digest. Grows the table to fit the
+        digests.
+        """
+        data = ''.join(digests)
+        high, low = self._words(data)
+        if len(high) != len(digests):
+            raise ValueError("Expected digests of {0} bytes".format(
+                DIGEST_SIZE))
+        _, first, inverse = numpy.unique(numpy.frombuffer(data,
+            dtype='S{0}'.format(DIGEST_SIZE)), return_index=True,
+            return_inverse=True)
+        # unique orders by digest: reorder by first occurrence
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+
+        capacity = len(self._high)
+        while self._count + len(first) > self.max_load * capacity:
+            capacity *= 2
+        if capacity != len(self._high):
+            self._grow(capacity)
+        return high, low, first[order], rank[inverse]
+
+    def add_many(self, digests):
+        """
+        Add a sequence of digests, returning a boolean array, true for each
+        digest which was not present before, including earlier in digests.
+        """
+        added = numpy.zeros(len(digests), dtype=bool)
+        if digests:
+            high, low, first, _ = self._batch(digests)
+            added[first] = self._insert(high[first], low[first])[0]
+        return added
+
+    def add(self, digest):
+        """
+        Add digest, returning True if it was not already present.
+        """
+        return bool(self.add_many([digest])[0])
+
+
+class DigestIndex(DigestSet):
+    """
+    DigestSet which numbers distinct digests from zero, in the order they
+    are first added.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        super(DigestIndex, self).__init__(capacity)
+        self._numbers = numpy.zeros(capacity, dtype=numpy.int64)
+
+    def _grow(self, capacity):
+        old_slots, new_slots = super(DigestIndex, self)._grow(capacity)
+        numbers = numpy.zeros(capacity, dtype=numpy.int64)
+        numbers[new_slots] = self._numbers[old_slots]
+        self._numbers = numbers
+        return old_slots, new_slots
+
+    def index_many(self, digests):
+        """
+        Add a sequence of digests, returning an array of the number of each
+        """
+        if not digests:
+            return numpy.zeros(0, dtype=numpy.int64)
+        high, low, first, inverse = self._batch(digests)
+        start = len(self)
+        added, slots = self._insert(high[first], low[first])
+        self._numbers[slots[added]] = numpy.arange(start, len(self))
+        return self._numbers[slots][inverse]
+
+
+def _batches(iterable, batch_size):
+    """
+    Generate lists of up to batch_size items from iterable
+    """
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _bloom_hashes(keys):
+    """
+    Array of two 64-bit hashes of each of keys, from their md5 digests, one
+    row per key
+    """
+    return numpy.frombuffer(''.join(hashlib.md5(key).digest()
+                                    for key in keys),
+                            dtype='<u8').reshape(-1, 2)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of strings, sized to hold capacity strings with a false
+    positive rate of about fpr.
+
+    Keys are added and tested in batches with numpy, setting hash_count bits
+    per key, at positions from double hashing of the key's md5 digest.
+    """
+
+    def __init__(self, capacity, fpr):
+        if not 0 < fpr < 1:
+            raise ValueError("False positive rate must be between 0 and 1, "
+                             "got {0}".format(fpr))
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(int(math.ceil(-capacity * math.log(fpr) /
+                                      math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(float(self.size) / capacity *
+                                        math.log(2))), 1)
+        self._bits = numpy.zeros((self.size + 7) // 8, dtype=numpy.uint8)
+        self._hash_multiples = numpy.arange(self.hash_count,
+                                            dtype=numpy.uint64)
+
+    def _positions(self, hashes):
+        """
+        Array of the bit positions for each row of hashes
+        """
+        # Arithmetic wraps modulo 2**64
+        positions = hashes[:, :1] + self._hash_multiples * hashes[:, 1:]
+        return positions % numpy.uint64(self.size)
+
+    def add_many(self, keys):
+        if not keys:
+            return
+        positions = self._positions(_bloom_hashes(keys)).ravel()
+        indexes = (positions >> numpy.uint64(3)).astype(numpy.intp)
+        bits = numpy.uint8(1) << (positions & numpy.uint64(7)).astype(
+            numpy.uint8)
+        # Combine the bits of each byte, as fancy assignment keeps only one
+        # value per index
+        order = numpy.argsort(indexes)
+        indexes, bits = indexes[order], bits[order]
+        starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], indexes[1:] != indexes[:-1])))
+        self._bits[indexes[starts]] |= numpy.bitwise_or.reduceat(bits,
+                                                                 starts)
+
+    def _contains_hashes(self, hashes):
+        """
+        contains_many, for keys with hashes from _bloom_hashes
+        """
+        if not len(hashes):
+            return numpy.zeros(0, dtype=bool)
+        positions = self._positions(hashes)
+        values = self._bits[(positions >> numpy.uint64(3)).astype(
+            numpy.intp)]
+        bits = (values >> (positions & numpy.uint64(7)).astype(numpy.uint8))
+        return (bits & 1).all(axis=1)
+
+    def contains_many(self, keys):
+        """
+        Boolean array, true for each of keys which may have been added, and
+        false for those which certainly were not.
+        """
+        return self._contains_hashes(_bloom_hashes(keys))
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key])[0])
+
+
+def _write_run(ids):
+    """
+    Write ids, one per line, to a temporary file, returned at its start
+    """
+    run_file = tempfile.TemporaryFile()
+    run_file.writelines(i + '\n' for i in ids)
+    run_file.seek(0)
+    return run_file
+
+
+def _merge_ids(iterables):
+    """
+    Generate the distinct IDs from iterables of sorted IDs, in sorted order
+    """
+    for i, _ in itertools.groupby(heapq.merge(*iterables)):
+        yield i
+
+
+def _sorted_ids(ids):
+    """
+    Generate the distinct ids in sorted order.
+
+    Runs of ID_SORT_RUN_SIZE IDs are sorted in memory and written to
+    temporary files. Whenever ID_MERGE_WIDTH runs of the same level
+    accumulate, they are merged into one run of the next level, so few files
+    are open at once.
+    """
+    runs = []
+    try:
+        for batch in _batches(ids, ID_SORT_RUN_SIZE):
+            run, level = _write_run(sorted(set(batch))), 0
+            del batch
+            merging = runs[1 - ID_MERGE_WIDTH:]
+            while (len(merging) == ID_MERGE_WIDTH - 1 and
+                   all(l == level for l, _ in merging)):
+                del runs[1 - ID_MERGE_WIDTH:]
+                run_files = [f for _, f in merging] + [run]
+                run = _write_run(_merge_ids(
+                    [(line[:-1] for line in f) for f in run_files]))
+                for f in run_files:
+                    f.close()
+                level += 1
+                merging = runs[1 - ID_MERGE_WIDTH:]
+            runs.append((level, run))
+        for i in _merge_ids([(line[:-1] for line in f) for _, f in runs]):
+            yield i
+    finally:
+        for _, f in runs:
+            f.close()
+
+
+class SortedIdFile(object):
+    """
+    Distinct IDs, sorted one per line in a temporary file, for exact lookups
+    on disk.
+
+    IDs are sorted on disk, unless presorted is true, when ids must already
+    be sorted and distinct. Every ID_INDEX_INTERVAL-th ID is kept in memory
+    with its offset, so that a lookup reads a single block of IDs.
+    """
+
+    def __init__(self, ids, presorted=False):
+        if not presorted:
+            ids = _sorted_ids(ids)
+        self._file = tempfile.TemporaryFile()
+        self._count = 0
+        self._index_ids = []
+        self._index_offsets = []
+        offset = 0
+        for i in ids:
+            if not self._count % ID_INDEX_INTERVAL:
+                self._index_ids.append(i)
+                self._index_offsets.append(offset)
+            self._file.write(i + '\n')
+            offset += len(i) + 1
+            self._count += 1
+        self._index_offsets.append(offset)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._file.seek(0)
+        return (line[:-1] for line in self._file)
+
+    def _block(self, number):
+        """
+        List of the IDs in block number
+        """
+        start, end = self._index_offsets[number:number + 2]
+        self._file.seek(start)
+        return self._file.read(end - start).split('\n')[:-1]
+
+    def contains_many(self, ids):
+        """
+        Boolean array, true for each of ids in the file.
+
+        IDs are looked up in sorted order, so that each block is read at most
+        once.
+        """
+        found = numpy.zeros(len(ids), dtype=bool)
+        block_number, block = None, []
+        for k in sorted(xrange(len(ids)), key=ids.__getitem__):
+            i = ids[k]
+            number = bisect.bisect_right(self._index_ids, i) - 1
+            if number < 0:
+                continue
+            if number != block_number:
+                block_number, block = number, self._block(number)
+            position = bisect.bisect_left(block, i)
+            found[k] = position < len(block) and block[position] == i
+        return found
+
+    def __contains__(self, i):
+        return bool(self.contains_many([i])[0])
+
+    def close(self):
+        self._file.close()
+
+
+class DiskIdSet(object):
+    """
+    Set of IDs added over time, held on disk in SortedIdFiles, each with a
+    Bloom filter of false positive rate fpr, for exact membership tests with
+    little memory.
+
+    Added IDs are held in memory until ID_SORT_RUN_SIZE accumulate, then
+    written to a file. Whenever ID_MERGE_WIDTH files of the same level
+    accumulate, they are merged into one of the next level, so there are few
+    files to check, and their filters skip most of those.
+    """
+
+    def __init__(self, fpr):
+        if not 0 < fpr < 1:
+            raise ValueError("False positive rate must be between 0 and 1, "
+                             "got {0}".format(fpr))
+        self.fpr = fpr
+        self._recent = set()
+        # (level, SortedIdFile, BloomFilter) tuples
+        self._files = []
+
+    def _add_file(self, sorted_ids, level):
+        merging = self._files[1 - ID_MERGE_WIDTH:]
+        if (len(merging) == ID_MERGE_WIDTH - 1 and
+                all(l == level for l, _, _ in merging)):
+            del self._files[1 - ID_MERGE_WIDTH:]
+            files = [f for _, f, _ in merging] + [sorted_ids]
+            merged = SortedIdFile(_merge_ids(files), presorted=True)
+            for f in files:
+                f.close()
+            self._add_file(merged, level + 1)
+        else:
+            bloom = BloomFilter(len(sorted_ids), self.fpr)
+            for batch in _batches(sorted_ids, ID_FILTER_BATCH_SIZE):
+                bloom.add_many(batch)
+            self._files.append((level, sorted_ids, bloom))
+
+    def add_many(self, ids):
+        self._recent.update(ids)
+        if len(self._recent) >= ID_SORT_RUN_SIZE:
+            self._add_file(SortedIdFile(sorted(self._recent), presorted=True),
+                           0)
+            self._recent = set()
+
+    def contains_many(self, ids):
+        """
+        Boolean array, true for each of ids in the set
+        """
+        found = numpy.fromiter((i in self._recent for i in ids), dtype=bool,
+                               count=len(ids))
+        hashes = _bloom_hashes(ids)
+        for _, sorted_ids, bloom in self._files:
+            unresolved = numpy.flatnonzero(~found)
+            if not len(unresolved):
+                break
+            check = unresolved[bloom._contains_hashes(hashes[unresolved])]
+            found[check] = sorted_ids.contains_many([ids[k] for k in check])
+        return found
+
+    def close(self):
+        for _, sorted_ids, _ in self._files:
+            sorted_ids.close()
+
+
+@contextlib.contextmanager
+def _id_filter(ids, fpr):
+    """
+    Context manager giving a function which takes a list of IDs and returns a
+    boolean array, true for those in ids.
+
+    IDs are tested against a Bloom filter with false positive rate fpr, and
+    any positives confirmed in a SortedIdFile, so only the filter's bits and
+    the file's index are held in memory.
+    """
+    sorted_ids = SortedIdFile(ids)
+    try:
+        bloom = BloomFilter(len(sorted_ids), fpr)
+        for batch in _batches(sorted_ids, ID_FILTER_BATCH_SIZE):
+            bloom.add_many(batch)
+
+        def contains(keys):
+            found = bloom.contains_many(keys)
+            positives = numpy.flatnonzero(found)
+            found[positives] = sorted_ids.contains_many(
+                    [keys[i] for i in positives])
+            return found
+        yield contains
+    finally:
+        sorted_ids.close()
+
+
+def _parse_cluster_pair(line):
+    representative, member, member_id = line.rstrip('\n').split('\t')
+    return int(representative), int(member), member_id
+
+
+def _format_cluster_pair(pair):
+    return '%d\t%d\t%s\n' % pair
+
+
+def _group_cluster_pairs(pairs, run_size=None):
+    """
+    Generate lists of member IDs for each representative, in order of the
+    representative, from a file of (representative position, member
+    position, member ID) lines.
+
+    The pairs are sorted on disk, in runs of run_size lines which are then
+    merged, so memory use doesn't depend on the number of pairs.
+    """
+    run_size = run_size or CLUSTER_SORT_RUN_SIZE
+    pairs.seek(0)
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.imap(_parse_cluster_pair,
+                                        itertools.islice(pairs, run_size)))
+            if not run:
+                break
+            run_file = tempfile.TemporaryFile()
+            runs.append(run_file)
+            run_file.writelines(itertools.imap(_format_cluster_pair, run))
+            run_file.seek(0)
+            del run
+
+        merged = heapq.merge(*[itertools.imap(_parse_cluster_pair, run_file)
+                               for run_file in runs])
+        for _, group in itertools.groupby(merged, operator.itemgetter(0)):
+            yield [member_id for _, _, member_id in group]
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+
+def deduplicate_sequences(records, out_file, pairs_file=None,
+                          canonical=False):
+    """
+    Remove any duplicate records with identical sequences, ignoring case,
+    keep the first instance seen and discard additional occurences.
+
+    If pairs_file is given, a tab-delimited representative ID, member ID
+    line is written to it for each record as it is read, where the
+    representative is the first record with the same sequence. If out_file
+    is given, the IDs of each set of records with identical sequences are
+    written to it once all records are read, one line per set, in order of
+    their first record; the sets are grouped from pairs sorted on disk.
+
+    Memory use grows with the number of distinct sequences: without either
+    file, only a compact digest of each is kept; otherwise the position and
+    ID of its first record is also kept.
+
+    If canonical is true, a sequence and its reverse complement are
+    identical.
     """
 
     logging.info('Applying _deduplicate_sequences generator: '
                  'removing any duplicate records with identical sequences.')
-    checksum_sequences = collections.defaultdict(list)
-    for record in records:
-        checksum = seguid(record.seq)
-        sequences = checksum_sequences[checksum]
-        if not sequences:
-            yield record
-        sequences.append(record.id)
+    if out_file is None and pairs_file is None:
+        digests = DigestSet()
+        for batch in _batches(records, DEDUPLICATE_BATCH_SIZE):
+            added = digests.add_many([sequence_digest(record.seq, canonical)
+                                      for record in batch])
+            for record, is_new in itertools.izip(batch, added):
+                if is_new:
+                    yield record
+        return
+
+    # Position and ID of the first record with each digest
+    representatives = {}
+    cluster_pairs = tempfile.TemporaryFile() if out_file is not None else None
+    try:
+        for i, record in enumerate(records):
+            digest = sequence_digest(record.seq, canonical)
+            representative = representatives.get(digest)
+            if representative is None:
+                representative = representatives[digest] = (i, record.id)
+                yield record
+            if pairs_file is not None:
+                pairs_file.write('%s\t%s\n' % (representative[1], record.id))
+            if cluster_pairs is not None:
+                cluster_pairs.write(_format_cluster_pair(
+                    (representative[0], i, record.id)))
+        del representatives
+
+        if pairs_file is not None:
+            pairs_file.close()
+        if cluster_pairs is not None:
+            with out_file:
+                for sequences in _group_cluster_pairs(cluster_pairs):
+                    out_file.write('%s\n' % (' '.join(sequences),))
+    finally:
+        if cluster_pairs is not None:
+            cluster_pairs.close()
+
+
+def _size_annotated(record, size):
+    """
+    Append ';size=N' to the ID of record, and to the ID at the start of its
+    description
+    """
+    record_id = record.id
+    record.id = '{0};size={1}'.format(record_id, size)
+    if record.description.split(None, 1)[:1] == [record_id]:
+        record.description = record.id + record.description[len(record_id):]
+    return record
 
-    if out_file is not None:
-        with out_file:
-            for sequences in checksum_sequences.itervalues():
-                out_file.write('%s\n' % (' '.join(sequences),))
+
+def dereplicate_sequences(records, sort_by_size=False, canonical=False):
+    """
+    Dereplicate records with identical sequences, ignoring case: once all
+    records are read, generate the first record with each sequence, with
+    ';size=N' appended to its ID, where N is the number of records with that
+    sequence. Records are in order of their first occurrence, or if
+    sort_by_size is true, of decreasing size, then first occurrence.
+
+    Only the first record with each sequence is kept, pickled to a
+    temporary file, with a count and file offset for each in arrays.
+
+    If canonical is true, a sequence and its reverse complement are
+    identical.
+    """
+    logging.info('Applying _dereplicate_sequences generator: '
+                 'counting and removing records with identical sequences.')
+    digests = DigestIndex()
+    counts = numpy.zeros(1024, dtype=numpy.int64)
+    offsets = numpy.zeros(1024, dtype=numpy.int64)
+    # Number of records written to the temporary file
+    written = 0
+    with tempfile.SpooledTemporaryFile(DEFAULT_BUFFER_SIZE,
+                                       mode='wb+') as tf:
+        for batch in _batches(records, DEDUPLICATE_BATCH_SIZE):
+            numbers = digests.index_many([sequence_digest(record.seq,
+                                                          canonical)
+                                          for record in batch])
+            if len(digests) > len(counts):
+                extra = numpy.zeros(max(len(counts), len(digests)),
+                                    dtype=numpy.int64)
+                counts = numpy.concatenate((counts, extra))
+                offsets = numpy.concatenate((offsets, extra))
+            counts += numpy.bincount(numbers, minlength=len(counts))
+            for record, number in itertools.izip(batch, numbers.tolist()):
+                if number == written:
+                    offsets[number] = tf.tell()
+                    _write_buffered_record(tf, record)
+                    written += 1
+
+        if sort_by_size:
+            # Stable, so equal sizes stay in order of first occurrence
+            order = numpy.argsort(-counts[:written], kind='mergesort')
+        else:
+            order = numpy.arange(written)
+        for number in order.tolist():
+            tf.seek(offsets[number])
+            yield _size_annotated(_read_buffered_record(tf), counts[number])
+
+
+def _partition_digests(records, partition_files, canonical=False):
+    """
+    Generate records, writing an entry for each to one of partition_files,
+    chosen by its sequence digest.
+    """
+    partitions = len(partition_files)
+    for i, record in enumerate(records):
+        digest = sequence_digest(record.seq, canonical)
+        partition = struct.unpack_from('<I', digest)[0] % partitions
+        partition_files[partition].write(digest + struct.pack('<q', i))
+        yield record
 
 
-def deduplicate_taxa(records):
+def _first_indexes(partition_file):
+    """
+    Replace the entries in partition_file with the sorted positions of the
+    first record with each digest.
+    """
+    partition_file.seek(0)
+    entries = numpy.fromfile(partition_file, dtype=_PARTITION_ENTRY)
+    # Entries are in input order, and unique's return_index is the first
+    # occurrence of each digest
+    first = numpy.unique(entries['digest'], return_index=True)[1]
+    indexes = numpy.sort(entries['index'][first])
+    del entries, first
+    partition_file.seek(0)
+    partition_file.truncate()
+    indexes.tofile(partition_file)
+
+
+def _read_indexes(index_file, chunk_size=65536):
+    """
+    Generate the positions written to index_file by _first_indexes
+    """
+    index_file.seek(0)
+    while True:
+        chunk = numpy.fromfile(index_file, dtype='<i8', count=chunk_size)
+        if not len(chunk):
+            break
+        for index in chunk.tolist():
+            yield index
+
+
+def deduplicate_sequences_partitioned(records, partitions, canonical=False):
+    """
+    Remove any duplicate records with identical sequences, as
+    deduplicate_sequences, for inputs with more distinct sequences than fit
+    in memory.
+
+    Records are buffered on disk, while their digests and positions are
+    divided between partitions temporary files. Each partition is then
+    deduplicated in memory in turn, leaving the positions of first
+    occurrences, which are merged to select records from the buffer in input
+    order.
+    """
+    logging.info('Applying _deduplicate_sequences_partitioned generator: '
+                 'removing any duplicate records with identical sequences, '
+                 'in %d partitions.', partitions)
+    partition_files = []
+    try:
+        for _ in xrange(partitions):
+            partition_files.append(tempfile.TemporaryFile())
+        with _record_buffer(_partition_digests(records, partition_files,
+                canonical)) as record_iter:
+            for partition_file in partition_files:
+                _first_indexes(partition_file)
+            first_indexes = heapq.merge(*[_read_indexes(f)
+                                          for f in partition_files])
+            next_index = next(first_indexes, None)
+            for i, record in enumerate(record_iter()):
+                if i == next_index:
+                    yield record
+                    next_index = next(first_indexes, None)
+    finally:
+        for partition_file in partition_files:
+            partition_file.close()
+
+
+def _taxid(record):
+    """
+    Taxon ID of a record, used by deduplicate_taxa
+    """
+    # Default to full ID, split if | is found.
+    taxid = record.id
+    if '|' in record.id:
+        try:
+            taxid = int(record.id.split("|")[0])
+        except:
+            # If we couldn't parse an integer from the ID, just fall back
+            # on the ID
+            logging.warn("Unable to parse integer taxid from %s",
+                    taxid)
+    return taxid
+
+
+def _deduplicate_taxa_filtered(records, fpr):
+    """
+    deduplicate_taxa, recording taxon IDs in a DiskIdSet with false positive
+    rate fpr, so that exact state is kept on disk.
+    """
+    seen = DiskIdSet(fpr)
+    try:
+        for batch in _batches(records, ID_FILTER_BATCH_SIZE):
+            # repr distinguishes integer taxon IDs from IDs, and contains no
+            # line breaks
+            keys = [repr(_taxid(record)) for record in batch]
+            found = seen.contains_many(keys)
+            added = set()
+            for record, key, is_found in itertools.izip(batch, keys, found):
+                if is_found or key in added:
+                    continue
+                added.add(key)
+                yield record
+            seen.add_many(added)
+    finally:
+        seen.close()
+
+
+def deduplicate_taxa(records, fpr=None):
     """
     Remove any duplicate records with identical IDs, keep the first
     instance seen and discard additional occurences.
+
+    If fpr is given, IDs seen are held on disk in a DiskIdSet, using Bloom
+    filters with false positive rate fpr, and positives confirmed exactly.
     """
     logging.info('Applying _deduplicate_taxa generator: ' + \
                  'removing any duplicate records with identical IDs.')
+    if fpr is not None:
+        for record in _deduplicate_taxa_filtered(records, fpr):
+            yield record
+        return
+
     taxa = set()
     for record in records:
-        # Default to full ID, split if | is found.
-        taxid = record.id
-        if '|' in record.id:
-            try:
-                taxid = int(record.id.split("|")[0])
-            except:
-                # If we couldn't parse an integer from the ID, just fall back
-                # on the ID
-                logging.warn("Unable to parse integer taxid from %s",
-                        taxid)
+        taxid = _taxid(record)
         if taxid in taxa:
             continue
         taxa.add(taxid)
@@ -125,11 +949,33 @@ def first_name_capture(records):
             yield record
 
 
-def include_from_file(records, handle):
+def _filter_ids(records, handle, keep, fpr):
+    """
+    Filter records by whether their IDs are in handle, using an ID filter
+    with false positive rate fpr. Records are kept where the result equals
+    keep.
+    """
+    with _id_filter((i.strip() for i in handle), fpr) as contains:
+        for batch in _batches(records, ID_FILTER_BATCH_SIZE):
+            found = contains([record.id.strip() for record in batch])
+            for record, is_found in itertools.izip(batch, found):
+                if is_found == keep:
+                    yield record
+
+
+def include_from_file(records, handle, fpr=None):
     """
     Filter the records, keeping only sequences whose ID is contained in the
     handle.
+
+    If fpr is given, IDs are held in a Bloom filter with false positive rate
+    fpr, and positives confirmed exactly against IDs sorted on disk.
     """
+    if fpr is not None:
+        for record in _filter_ids(records, handle, True, fpr):
+            yield record
+        return
+
     ids = set(i.strip() for i in handle)
 
     for record in records:
@@ -137,11 +983,18 @@ def include_from_file(records, handle):
             yield record
 
 
-def exclude_from_file(records, handle):
+def exclude_from_file(records, handle, fpr=None):
     """
     Filter the records, keeping only sequences whose ID is not contained in the
     handle.
+
+    If fpr is given, IDs are held as for include_from_file.
     """
+    if fpr is not None:
+        for record in _filter_ids(records, handle, False, fpr):
+            yield record
+        return
+
     ids = set(i.strip() for i in handle)
 
     for record in records:
@@ -661,6 +1514,45 @@ def min_ungap_length_discard(records, min_length):
             yield record
 
 
+def quality_bin_table(bins):
+    """
+    Build a translation table for bytearray.translate mapping each Phred
+    score to its binned value.
+
+    bins is a sequence of (minimum score, binned score) pairs; each score is
+    mapped to the binned score of the bin with the largest minimum not
+    exceeding it. Scores below all minimums are unchanged.
+    """
+    table = bytearray(xrange(256))
+    bins = sorted(bins)
+    ends = [minimum for minimum, _ in bins[1:]] + [len(table)]
+    for (minimum, value), end in zip(bins, ends):
+        table[minimum:end] = bytearray([value]) * (end - minimum)
+    return str(table)
+
+
+def bin_record_quality(record, table):
+    """
+    Replace the Phred scores of record with their binned values, using a table
+    from quality_bin_table. Records without Phred scores are unchanged.
+    """
+    scores = record.letter_annotations.get('phred_quality')
+    if scores is not None:
+        record.letter_annotations['phred_quality'] = list(
+                bytearray(scores).translate(table))
+    return record
+
+
+def bin_quality_scores(records, bins):
+    """
+    Bin the Phred quality scores of records, as (minimum score, binned score)
+    pairs.
+    """
+    table = quality_bin_table(bins)
+    for record in records:
+        yield bin_record_quality(record, table)
+
+
 def sort_length(source_file, source_file_type, direction=1):
     """
     Sort sequences by length. 1 is ascending (default) and 0 is descending.